@@ -0,0 +1,119 @@
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import List, Optional
+import numpy as np
+
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", 1024))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", 3600))
+# Near-duplicate tier: reuse answers for questions whose embeddings are almost identical
+ANSWER_CACHE_SEMANTIC = os.getenv("ANSWER_CACHE_SEMANTIC", "0") == "1"
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", 0.95))
+
+
+def normalize_question(question: str) -> str:
+    """Normalize question text so trivial variations share a cache entry"""
+    question = unicodedata.normalize("NFKC", question).lower()
+    question = re.sub(r"[?!.,;:\"'״׳()\[\]]", " ", question)
+    return " ".join(question.split())
+
+
+class AnswerCache:
+    """LRU + TTL cache of workflow responses scoped to a vectorstore, user budgets and prompt version"""
+
+    def __init__(self, max_size: int = ANSWER_CACHE_SIZE, ttl: float = ANSWER_CACHE_TTL,
+                 semantic: bool = ANSWER_CACHE_SEMANTIC, similarity: float = ANSWER_CACHE_SIMILARITY):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.semantic = semantic
+        self.similarity = similarity
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _scope(file_hash: str, user_info, prompt_version: str) -> str:
+        scope = json.dumps([file_hash, user_info, prompt_version], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(scope.encode("utf-8")).hexdigest()
+
+    def get(self, question: str, file_hash: str, user_info, prompt_version: str,
+            query_vector: Optional[List[float]] = None) -> Optional[dict]:
+        """Return a cached response for the question, or None"""
+        scope = self._scope(file_hash, user_info, prompt_version)
+        key = (scope, normalize_question(question))
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry["expires_at"] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry["response"]
+            if entry:
+                del self._entries[key]
+
+            if self.semantic and query_vector is not None:
+                match = self._nearest(scope, query_vector, now)
+                if match is not None:
+                    self._entries.move_to_end(match)
+                    self.semantic_hits += 1
+                    return self._entries[match]["response"]
+
+            self.misses += 1
+            return None
+
+    def _nearest(self, scope: str, query_vector: List[float], now: float):
+        """Find the most similar live entry in the same scope above the similarity threshold"""
+        candidates = [key for key, entry in self._entries.items()
+                      if key[0] == scope and entry["vector"] is not None and entry["expires_at"] > now]
+        if not candidates:
+            return None
+        matrix = np.array([self._entries[key]["vector"] for key in candidates], dtype="float32")
+        query = np.array(query_vector, dtype="float32")
+        norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(query)
+        scores = matrix @ query / np.where(norms == 0, 1, norms)
+        best = int(np.argmax(scores))
+        return candidates[best] if scores[best] >= self.similarity else None
+
+    def put(self, question: str, file_hash: str, user_info, prompt_version: str, response: dict,
+            query_vector: Optional[List[float]] = None):
+        """Store a response, evicting the least recently used entries over the size limit"""
+        scope = self._scope(file_hash, user_info, prompt_version)
+        key = (scope, normalize_question(question))
+        with self._lock:
+            self._entries[key] = {
+                "response": response,
+                "file_hash": file_hash,
+                "vector": query_vector if self.semantic else None,
+                "expires_at": time.time() + self.ttl
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, current_file_hash: Optional[str] = None):
+        """Drop entries built against any vectorstore other than the current one"""
+        with self._lock:
+            stale = [key for key, entry in self._entries.items() if entry["file_hash"] != current_file_hash]
+            for key in stale:
+                del self._entries[key]
+        if stale:
+            print(f"Answer cache: invalidated {len(stale)} entries")
+
+    def stats(self) -> dict:
+        """Get cache counters"""
+        with self._lock:
+            lookups = self.hits + self.semantic_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.hits + self.semantic_hits) / lookups, 4) if lookups else 0.0
+            }
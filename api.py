@@ -1,106 +1,179 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 import os
+import json
+import time
+import threading
 from pathlib import Path
-from rag import create_vectorstore, get_file_hash, load_document, load_vectorstore, save_vectorstore,embeddings
+from rag import embeddings, embedding_cache, cached_embeddings, is_memory_mapped, describe_index, load_vectorstore
+from indexer import index_manager, scan_corpus, FILES_DIR
+from watcher import FileWatcher
 from graph import app_graph
-from llm import model
+from llm import model, PROMPT_VERSION, GENERATION_ERROR_ANSWER, DEFAULT_USER_INFO
+from batch import answer_batch, parse_batch, BATCH_MAX_ITEMS
+from answer_cache import AnswerCache
+from query_planner import query_planner
+from tracing import start_trace, tracing_config, render_metrics, request_duration
 
 # Initialize Flask app
 app = Flask(__name__)
 CORS(app)
 
 # Configuration
-FILES_DIR = "files"
-SUPPORTED_EXTENSIONS = ['.xlsx', '.csv', '.txt', '.json']
+MAX_IN_FLIGHT = int(os.getenv("MAX_IN_FLIGHT", 32))
+MAX_QUEUED = int(os.getenv("MAX_QUEUED", 64))
+QUEUE_TIMEOUT = float(os.getenv("QUEUE_TIMEOUT", 30))
+# Threads kept free of /api/ask for status, metrics, streaming and batch requests
+SERVER_SPARE_THREADS = int(os.getenv("SERVER_SPARE_THREADS", 16))
+# Each request runs on a waitress worker thread, so a queued question holds a thread while it waits
+SERVER_THREADS = int(os.getenv("SERVER_THREADS", MAX_IN_FLIGHT + MAX_QUEUED + SERVER_SPARE_THREADS))
+# Only as many questions can queue in the limiter as there are threads left to wait in
+ASK_MAX_QUEUED = max(0, min(MAX_QUEUED, SERVER_THREADS - MAX_IN_FLIGHT - SERVER_SPARE_THREADS))
+WARM_START = os.getenv("WARM_START", "1") == "1"
+# Reindex automatically when the data file in FILES_DIR changes
+WATCH_FILES = os.getenv("WATCH_FILES", "1") == "1"
+MAX_CONCURRENT_BATCHES = int(os.getenv("MAX_CONCURRENT_BATCHES", 1))
+
+class InFlightLimiter:
+    """Cap concurrent workflow runs and queue the excess up to a limit"""
+
+    def __init__(self, max_in_flight: int, max_queued: int, timeout: float):
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self.in_flight = 0
+        self.queued = 0
+        self.rejected = 0
+
+    def acquire(self) -> bool:
+        with self._lock:
+            if self.queued >= self.max_queued:
+                self.rejected += 1
+                return False
+            self.queued += 1
+        acquired = self._slots.acquire(timeout=self.timeout)
+        with self._lock:
+            self.queued -= 1
+            if acquired:
+                self.in_flight += 1
+            else:
+                self.rejected += 1
+        return acquired
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "in_flight": self.in_flight,
+                "queued": self.queued,
+                "rejected": self.rejected,
+                "max_in_flight": self.max_in_flight,
+                "max_queued": self.max_queued
+            }
+
+ask_limiter = InFlightLimiter(MAX_IN_FLIGHT, ASK_MAX_QUEUED, QUEUE_TIMEOUT)
+# Batches run their own bounded generation pool, so only a few may run at once
+batch_slots = threading.BoundedSemaphore(MAX_CONCURRENT_BATCHES)
+answer_cache = AnswerCache()
+# Cached answers from the previous vectorstore are stale once a new one is swapped in
+index_manager.on_swap(lambda vectorstore, file_hash: answer_cache.invalidate(file_hash))
+file_watcher = FileWatcher(index_manager)
 
 # Global variables
-current_vectorstore = None
-current_file_hash = None
-system_initialized = False
+startup_stats = {"warm_start_seconds": None, "memory_mapped": False}
 
 @app.route('/api/status', methods=['GET'])
 def get_status():
     """Get system status"""
-    global system_initialized, current_vectorstore
-    
     if not model or not embeddings:
         return jsonify({
             "status": "error on init moduls of AWS Bedrock",
             "initialized": False
         })
     
-    if system_initialized and current_vectorstore:
+    vectorstore, _ = index_manager.snapshot()
+    if vectorstore is not None:
         return jsonify({
             "status": "system ready for use",
-            "initialized": True
+            "initialized": True,
+            "vector_index": {"type": describe_index(vectorstore.index), "vectors": vectorstore.index.ntotal},
+            "embedding_cache": embedding_cache.stats(),
+            "query_embedding_cache": cached_embeddings.query_stats(),
+            "requests": ask_limiter.stats(),
+            "answer_cache": answer_cache.stats(),
+            "query_rewrite": query_planner.stats(),
+            "startup": startup_stats,
+            "watcher": file_watcher.stats()
         })
     else:
         return jsonify({
             "status": "system not initialized",
-            "initialized": False
+            "initialized": False,
+            "embedding_cache": embedding_cache.stats(),
+            "startup": startup_stats
         })
 
 @app.route('/api/initialize', methods=['GET'])#TODO:change to POST
 def initialize_system():
-    """Initialize the RAG system"""
+    """Initialize the RAG system by building the vectorstore in the background"""
     # TODO:move it to redis
-    global current_vectorstore, current_file_hash, system_initialized
-    
     try:
-        # Look for data file in files directory
-        data_file = None
-        for ext in SUPPORTED_EXTENSIONS:
-            potential_file = os.path.join(FILES_DIR, f"data{ext}")
-            if os.path.exists(potential_file):
-                data_file = potential_file
-                break
-        
-        if not data_file:
+        manifest, file_hash = scan_corpus()
+        
+        if not manifest:
             return jsonify({
                 "success": False,
                 "status": f"no file in{FILES_DIR}",
                 "error": "file not found"
             }), 400
         
-        # Get file hash
-        file_hash = get_file_hash(data_file)
+        files_processed = sorted(manifest)
+        _, current_file_hash = index_manager.snapshot()
         
-        # Check if we need to create new vectorstore
-        if current_file_hash != file_hash:
-            print("Creating new vectorstore...")
-            
-            # Try to load existing vectorstore
-            vectorstore = load_vectorstore(file_hash)
-            
-            if vectorstore is None:
-                # Create new vectorstore
-                print("Loading and processing document...")
-                documents = load_document(data_file)
-                
-                if not documents:
-                    return jsonify({
-                        "success": False,
-                        "status": "Error loading file",
-                        "error": "Could not load the file"
-                    }), 400
-                
-                print("Creating vectorstore...")
-                vectorstore = create_vectorstore(documents)
-                
-                # Save vectorstore
-                save_vectorstore(vectorstore, file_hash)
-            
-            current_vectorstore = vectorstore
-            current_file_hash = file_hash
+        if current_file_hash == file_hash:
+            return jsonify({
+                "success": True,
+                "status": "successfully initialized system",
+                "file_processed": ", ".join(files_processed),
+                "files_processed": files_processed
+            })
         
-        system_initialized = True
+        # Queries keep using the current vectorstore until the new one is swapped in
+        print("Creating new vectorstore...")
+        job = index_manager.submit(manifest, file_hash)
+        
+        # ?wait=true keeps the old blocking behaviour for scripts
+        if request.args.get('wait', '').lower() in ('1', 'true', 'yes'):
+            index_manager.wait(job)
+            if job.status == "failed":
+                return jsonify({
+                    "success": False,
+                    "status": "error initializing system",
+                    "error": job.error,
+                    "job": job.to_dict()
+                }), 500
+            return jsonify({
+                "success": True,
+                "status": "successfully initialized system",
+                "file_processed": ", ".join(files_processed),
+                "files_processed": files_processed,
+                "job": job.to_dict()
+            })
         
         return jsonify({
             "success": True,
-            "status": "successfully initialized system",
-            "file_processed": os.path.basename(data_file)
-        })
+            "status": "index build started",
+            "file_processed": ", ".join(files_processed),
+            "files_processed": files_processed,
+            "job_id": job.id,
+            "job": job.to_dict()
+        }), 202
         
     except Exception as e:
         print(f"Error initializing system: {e}")
@@ -110,11 +183,75 @@ def initialize_system():
             "error": str(e)
         }), 500
 
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Get progress of a background index build"""
+    job = index_manager.get_job(job_id)
+    if not job:
+        return jsonify({"error": "job not found"}), 404
+    return jsonify(job.to_dict())
+
+def warm_start():
+    """Load the saved vectorstore for the current corpus at startup, queueing a background build if there is none"""
+    started = time.perf_counter()
+    try:
+        manifest, file_hash = scan_corpus()
+        if not manifest:
+            print(f"Warm start skipped: no data files in {FILES_DIR}")
+            return
+        vectorstore = load_vectorstore(file_hash)
+        if vectorstore is not None:
+            index_manager.swap(vectorstore, file_hash, manifest)
+        else:
+            job = index_manager.submit(manifest, file_hash)
+            print(f"No saved vectorstore for the current files, building in the background (job {job.id})")
+    except Exception as e:
+        print(f"Error during warm start: {e}")
+    finally:
+        vectorstore, _ = index_manager.snapshot()
+        startup_stats["warm_start_seconds"] = round(time.perf_counter() - started, 3)
+        startup_stats["memory_mapped"] = bool(vectorstore) and is_memory_mapped(vectorstore)
+        print(f"Warm start finished in {startup_stats['warm_start_seconds']}s")
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Expose latency and token metrics in Prometheus text format"""
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+def debug_timing_requested() -> bool:
+    """Check if the client asked for a per-request timing breakdown"""
+    return request.headers.get("X-Debug-Timing", "").lower() in ("1", "true", "yes")
+
+def get_user_info():
+    """Get the budgets available to the asking user"""
+    # user_info = request.args.get('user_info', '').strip()
+    # user_info = "סל מנהיגות חינוכית, סל חינוך חברתי - קהילתי והעשרה, סל אוכלוסיות במיקוד"
+    user_info = list(DEFAULT_USER_INFO)
+    # user_info = "סל מנהיגות חינוכית"
+    return user_info
+
+def build_initial_state(question: str, vectorstore, user_info, query_embedding=None) -> dict:
+    """Create initial workflow state for a question"""
+    return {
+        "messages": [],
+        "question": question,
+        "vectorstore": vectorstore,
+        "retrieved_docs": [],
+        "answer": "",
+        "search_query": "",
+        "sources": [],
+        "user_info": user_info,
+        "query_embedding": query_embedding,
+        "query_filters": {},
+        "retrieval_branches": {},
+        "retrieval_error": None
+    }
+
 @app.route('/api/ask', methods=['GET'])#TOOD:change to POST
 def ask_question():
     """Process question and return answer"""
-    global current_vectorstore
-    
+    started = time.perf_counter()
+    trace = start_trace()
     try:
         # data = request.get_json()
         # question = data.get('question', '').strip()
@@ -127,36 +264,49 @@ def ask_question():
                 "answer": "Please enter a valid question"
             }), 400
         
-        if not current_vectorstore:
+        # One consistent vectorstore/hash pair per request, even if a rebuild swaps mid-request
+        vectorstore, file_hash = index_manager.snapshot()
+        if not vectorstore:
             return jsonify({
                 "error": " System not initialized",
                 "answer": "The system has not been initialized yet. Please wait for the system to initialize."
             }), 400
-        # user_info = request.args.get('user_info', '').strip()
-        # user_info = "סל מנהיגות חינוכית, סל חינוך חברתי - קהילתי והעשרה, סל אוכלוסיות במיקוד"
-        user_info = ["סל תשתיות בית ספריות", "סל מנהיגות חינוכית", "סל חינוך חברתי - קהילתי והעשרה", "סל אוכלוסיות במיקוד"]
-        # user_info = "סל מנהיגות חינוכית"
-        # Create initial state
-        initial_state = {
-            "messages": [],
-            "question": question,
-            "vectorstore": current_vectorstore,
-            "retrieved_docs": [],
-            "answer": "",
-            "search_query": "",
-            "sources": [],
-            "user_info": user_info
-        }
+        user_info = get_user_info()
+        
+        # The question embedding is only needed up front for the near-duplicate cache tier
+        query_embedding = cached_embeddings.embed_query(question) if answer_cache.semantic else None
+        cached = answer_cache.get(question, file_hash, user_info, PROMPT_VERSION, query_embedding)
+        if cached:
+            request_duration.observe(time.perf_counter() - started, endpoint="ask", cached="true")
+            return jsonify({**cached, "question": question, "cached": True})
+        
+        initial_state = build_initial_state(question, vectorstore, user_info, query_embedding)
         print(f"----------Processing question: {question}-----------")
-        # Run the workflow
-        result = app_graph.invoke(initial_state)
+        if not ask_limiter.acquire():
+            return jsonify({
+                "error": "Server busy",
+                "answer": "The system is handling too many questions right now. Please try again shortly."
+            }), 503
+        try:
+            # Run the workflow
+            result = app_graph.invoke(initial_state, config=tracing_config())
+        finally:
+            ask_limiter.release()
         
-        return jsonify({
+        response = {
             "answer": result["answer"],
             "sources": result["sources"],
             "question": question,
             "search_query": result["search_query"]
-        })
+        }
+        if result["answer"] != GENERATION_ERROR_ANSWER:
+            answer_cache.put(question, file_hash, user_info, PROMPT_VERSION, response, query_embedding)
+        
+        elapsed = time.perf_counter() - started
+        request_duration.observe(elapsed, endpoint="ask", cached="false")
+        if debug_timing_requested():
+            return jsonify({**response, "timings": {**trace, "total_ms": round(elapsed * 1000, 3)}})
+        return jsonify(response)
         
     except Exception as e:
         print(f"Error processing question: {e}")
@@ -165,6 +315,156 @@ def ask_question():
             "answer": "Sorry, an error occurred while processing the question. Please try again."
         }), 500
 
+def sse_event(event: str, data: dict) -> str:
+    """Format a Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def message_text(message) -> str:
+    """Extract text from a streamed chat message chunk"""
+    if isinstance(message.content, str):
+        return message.content
+    return "".join(part.get("text", "") for part in message.content if isinstance(part, dict))
+
+@app.route('/api/ask/stream', methods=['GET'])
+def ask_question_stream():
+    """Process question and stream sources and answer tokens as Server-Sent Events"""
+    question = request.args.get('question', '').strip()
+    
+    if not question:
+        return jsonify({
+            "error": "Question not found",
+            "answer": "Please enter a valid question"
+        }), 400
+    
+    vectorstore, file_hash = index_manager.snapshot()
+    if not vectorstore:
+        return jsonify({
+            "error": " System not initialized",
+            "answer": "The system has not been initialized yet. Please wait for the system to initialize."
+        }), 400
+    
+    user_info = get_user_info()
+    query_embedding = cached_embeddings.embed_query(question) if answer_cache.semantic else None
+    cached = answer_cache.get(question, file_hash, user_info, PROMPT_VERSION, query_embedding)
+    
+    if not cached and not ask_limiter.acquire():
+        return jsonify({
+            "error": "Server busy",
+            "answer": "The system is handling too many questions right now. Please try again shortly."
+        }), 503
+    
+    def generate_events():
+        if cached:
+            yield sse_event("sources", {"sources": cached["sources"]})
+            yield sse_event("done", {**cached, "question": question, "cached": True})
+            return
+        
+        try:
+            print(f"----------Streaming question: {question}-----------")
+            result = {}
+            initial_state = build_initial_state(question, vectorstore, user_info, query_embedding)
+            # "updates" carries each node's output, "messages" the LLM tokens as they are generated
+            for mode, chunk in app_graph.stream(initial_state, stream_mode=["updates", "messages"], config=tracing_config()):
+                if mode == "updates":
+                    for node, update in chunk.items():
+                        if node == "retrieve":
+                            yield sse_event("sources", {"sources": update["sources"]})
+                        result.update(update or {})
+                elif mode == "messages":
+                    message, metadata = chunk
+                    token = message_text(message)
+                    if metadata.get("langgraph_node") == "generate" and token:
+                        yield sse_event("token", {"token": token})
+            
+            response = {
+                "answer": result.get("answer", ""),
+                "sources": result.get("sources", []),
+                "question": question,
+                "search_query": result.get("search_query", "")
+            }
+            if response["answer"] and response["answer"] != GENERATION_ERROR_ANSWER:
+                answer_cache.put(question, file_hash, user_info, PROMPT_VERSION, response, query_embedding)
+            yield sse_event("done", response)
+        
+        except Exception as e:
+            print(f"Error streaming question: {e}")
+            yield sse_event("error", {
+                "error": "Error processing question",
+                "answer": "Sorry, an error occurred while processing the question. Please try again."
+            })
+    
+    response = Response(
+        stream_with_context(generate_events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+    if not cached:
+        # Runs when the response is closed, even if the client left before the generator was first iterated
+        response.call_on_close(ask_limiter.release)
+    return response
+
+@app.route('/api/ask/batch', methods=['POST'])
+def ask_batch():
+    """Answer a JSONL body of questions, streaming one JSON result line per question as it finishes"""
+    vectorstore, file_hash = index_manager.snapshot()
+    if not vectorstore:
+        return jsonify({
+            "error": " System not initialized",
+            "answer": "The system has not been initialized yet. Please wait for the system to initialize."
+        }), 400
+    
+    try:
+        items = parse_batch(request.get_data(as_text=True).splitlines())
+    except ValueError as e:
+        return jsonify({"error": f"Invalid batch: {e}"}), 400
+    if not items:
+        return jsonify({"error": "Invalid batch: no questions"}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"Batch too large: at most {BATCH_MAX_ITEMS} questions"}), 413
+    
+    if not batch_slots.acquire(blocking=False):
+        return jsonify({"error": "Server busy", "answer": "Another batch is running. Please try again shortly."}), 503
+    
+    def generate_lines():
+        try:
+            print(f"----------Processing batch of {len(items)} questions-----------")
+            for result in answer_batch(items, vectorstore, file_hash, get_user_info(), answer_cache):
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+        except Exception as e:
+            print(f"Error processing batch: {e}")
+            yield json.dumps({"error": "Error processing batch"}) + "\n"
+    
+    response = Response(stream_with_context(generate_lines()), mimetype="application/x-ndjson")
+    # Runs when the response is closed, even if the client left before the generator was first iterated
+    response.call_on_close(batch_slots.release)
+    return response
+
+startup_lock = threading.Lock()
+serving_started = False
+
+def create_app() -> Flask:
+    """Warm start and watch the data files once, then return the app for serving
+
+    Every server entry point goes through here, e.g. `waitress-serve --call api:create_app` or
+    `gunicorn "api:create_app()"`; importing api alone has no side effects.
+    """
+    global serving_started
+    with startup_lock:
+        if not serving_started:
+            serving_started = True
+            if WARM_START:
+                warm_start()
+            if WATCH_FILES:
+                file_watcher.start()
+    return app
+
 if __name__ == '__main__':
     print("Starting RAG Backend...")
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    create_app()
+    if os.getenv("FLASK_DEBUG"):
+        app.run(debug=True, host='0.0.0.0', port=5000)
+    else:
+        from waitress import serve
+        # One connection per thread: excess connections wait in the listen backlog instead of waitress's unbounded task queue
+        # (waitress counts its listening socket and wakeup trigger against the limit too)
+        serve(app, host='0.0.0.0', port=5000, threads=SERVER_THREADS, connection_limit=SERVER_THREADS + 2)
\ No newline at end of file
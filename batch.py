@@ -0,0 +1,214 @@
+"""Batch question answering for regression sets and pre-computed answers.
+
+Questions are embedded together, searched as one FAISS matrix query per filter
+and answered on a bounded worker pool; results stream back as they finish.
+
+    python batch.py questions.jsonl --output answers.jsonl --workers 8
+
+Each input line is {"question": ..., "id": ..., "user_info": [...]} (id and
+user_info optional) or a plain JSON string.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Iterable, Iterator, List
+import numpy as np
+from langchain_community.vectorstores import FAISS
+
+if __name__ == "__main__":
+    # stdout carries the JSONL results, so the modules' log prints, including those at import, go to stderr
+    sys.stdout = sys.stderr
+from rag import cached_embeddings
+from llm import (generate_answer, process_user_queries, retrieve_documents_batch, route_answer,
+                 TEMPLATED_ANSWERS, PROMPT_VERSION, GENERATION_ERROR_ANSWER, DEFAULT_USER_INFO)
+from tracing import start_trace, traced_node, tracing_config, request_duration
+
+BATCH_MAX_WORKERS = int(os.getenv("BATCH_MAX_WORKERS", 4))
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 10000))
+# Questions embedded and searched together before their answers are generated
+BATCH_CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE", 256))
+# Per-item timings of stages run once for a whole chunk
+SHARED_STAGES = ("rewrite_ms", "embed_ms", "search_ms")
+
+# Same answer routes as the workflow's conditional edges
+answer_nodes = {"generate": traced_node("generate", generate_answer),
+                **{name: traced_node(name, answer) for name, answer in TEMPLATED_ANSWERS.items()}}
+
+
+def parse_batch(lines: Iterable[str]) -> List[dict]:
+    """Parse JSONL lines into batch items, raising ValueError on the first invalid line"""
+    items = []
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError as e:
+            raise ValueError(f"line {line_number}: invalid JSON ({e})")
+        if isinstance(item, str):
+            item = {"question": item}
+        if not isinstance(item, dict) or not str(item.get("question", "")).strip():
+            raise ValueError(f"line {line_number}: missing question")
+        items.append({
+            "id": item.get("id", len(items)),
+            "question": str(item["question"]).strip(),
+            "user_info": item.get("user_info")
+        })
+    return items
+
+
+def _initial_state(item: dict, vectorstore: FAISS, user_info) -> dict:
+    return {
+        "messages": [],
+        "question": item["question"],
+        "vectorstore": vectorstore,
+        "retrieved_docs": [],
+        "answer": "",
+        "search_query": "",
+        "sources": [],
+        "user_info": item.get("user_info") or user_info,
+        "query_embedding": None,
+        "query_filters": {},
+        "retrieval_branches": {},
+        "retrieval_error": None
+    }
+
+
+def _response(state: dict) -> dict:
+    return {
+        "answer": state["answer"],
+        "sources": state["sources"],
+        "question": state["question"],
+        "search_query": state["search_query"]
+    }
+
+
+def _generate(state: dict) -> dict:
+    trace = start_trace()
+    started = time.perf_counter()
+    result = answer_nodes[route_answer(state)].invoke(state, config=tracing_config())
+    return {"state": result, "generate_ms": round((time.perf_counter() - started) * 1000, 3),
+            "tokens": trace["tokens"]}
+
+
+def answer_batch(items: List[dict], vectorstore: FAISS, file_hash: str, user_info,
+                 answer_cache=None, max_workers: int = BATCH_MAX_WORKERS) -> Iterator[dict]:
+    """Answer batch items, yielding one result per item in completion order"""
+    def finish(item, index, response, timings, started, cached=False, error=None):
+        # An item's total is its share of the chunk's shared stages plus its own time since it was submitted
+        shared_ms = sum(timings.get(stage, 0) for stage in SHARED_STAGES)
+        total = shared_ms / 1000 + time.perf_counter() - started
+        request_duration.observe(total, endpoint="batch", cached=str(cached).lower())
+        result = {"id": item["id"], "index": index, **response, "cached": cached,
+                  "timings": {**timings, "total_ms": round(total * 1000, 3)}}
+        if error:
+            result["error"] = error
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="batch") as executor:
+        pending = {}
+        for chunk_start in range(0, len(items), BATCH_CHUNK_SIZE):
+            chunk = items[chunk_start:chunk_start + BATCH_CHUNK_SIZE]
+            # Rewrites for the whole chunk run concurrently against one deadline
+            rewrite_started = time.perf_counter()
+            states = process_user_queries([_initial_state(item, vectorstore, user_info) for item in chunk])
+            rewrite_ms = (time.perf_counter() - rewrite_started) * 1000
+
+            # One batched embedding pass for every query in the chunk not already in the query cache
+            embed_started = time.perf_counter()
+            texts = [state["search_query"] for state in states]
+            vectors = np.array(cached_embeddings.embed_queries(texts), dtype="float32")
+            embed_ms = (time.perf_counter() - embed_started) * 1000
+
+            # Cached answers skip retrieval and generation entirely
+            # Shared stages are reported per item as their amortized cost
+            timings = {"rewrite_ms": round(rewrite_ms / len(states), 3), "embed_ms": round(embed_ms / len(states), 3)}
+            to_answer = []
+            for offset, state in enumerate(states):
+                item, index = chunk[offset], chunk_start + offset
+                cached = answer_cache.get(state["question"], file_hash, state["user_info"], PROMPT_VERSION,
+                                          vectors[offset].tolist()) if answer_cache is not None else None
+                if cached:
+                    yield finish(item, index, {**cached, "question": state["question"]}, timings,
+                                 time.perf_counter(), cached=True)
+                else:
+                    to_answer.append(offset)
+            if not to_answer:
+                continue
+
+            search_started = time.perf_counter()
+            retrieved = retrieve_documents_batch([states[offset] for offset in to_answer], vectors[to_answer])
+            search_ms = (time.perf_counter() - search_started) * 1000
+            timings = {**timings, "search_ms": round(search_ms / len(to_answer), 3)}
+
+            for offset, state in zip(to_answer, retrieved):
+                future = executor.submit(_generate, state)
+                pending[future] = (chunk[offset], chunk_start + offset, vectors[offset], timings, time.perf_counter())
+                # Keep a bounded number of generations queued so results stream out steadily
+                while len(pending) >= max_workers * 2:
+                    yield from _collect(pending, finish, file_hash, answer_cache)
+        while pending:
+            yield from _collect(pending, finish, file_hash, answer_cache)
+
+
+def _collect(pending: dict, finish, file_hash: str, answer_cache) -> Iterator[dict]:
+    """Wait for at least one generation to finish and yield the results of all finished ones"""
+    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+    for future in done:
+        item, index, vector, timings, started = pending.pop(future)
+        try:
+            generated = future.result()
+        except Exception as e:
+            print(f"Error answering batch item {item['id']}: {e}")
+            yield finish(item, index, {"answer": GENERATION_ERROR_ANSWER, "sources": [], "question": item["question"],
+                                       "search_query": ""}, timings, started, error=str(e))
+            continue
+        state = generated["state"]
+        response = _response(state)
+        if answer_cache is not None and state["answer"] != GENERATION_ERROR_ANSWER:
+            answer_cache.put(state["question"], file_hash, state["user_info"], PROMPT_VERSION, response, vector.tolist())
+        yield finish(item, index, response, {**timings, "generate_ms": generated["generate_ms"],
+                                             "tokens": generated["tokens"]}, started, error=state.get("retrieval_error"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a JSONL file of questions")
+    parser.add_argument("input", help="JSONL file of questions, - for stdin")
+    parser.add_argument("--output", help="write JSONL results here instead of stdout")
+    parser.add_argument("--workers", type=int, default=BATCH_MAX_WORKERS, help="concurrent generations")
+    args = parser.parse_args()
+
+    from indexer import index_manager, scan_corpus
+
+    output = open(args.output, "w", encoding="utf-8") if args.output else sys.__stdout__
+    started = time.perf_counter()
+    totals, errors = [], 0
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            manifest, file_hash = scan_corpus()
+            vectorstore = index_manager.build(manifest, file_hash) if manifest else None
+            if vectorstore is None:
+                sys.exit("No vectorstore: add data files to the files directory")
+            with (sys.stdin if args.input == "-" else open(args.input, "r", encoding="utf-8")) as f:
+                items = parse_batch(f)
+
+            started = time.perf_counter()
+            for result in answer_batch(items, vectorstore, file_hash, DEFAULT_USER_INFO, max_workers=args.workers):
+                output.write(json.dumps(result, ensure_ascii=False) + "\n")
+                output.flush()
+                totals.append(result["timings"]["total_ms"])
+                errors += "error" in result
+    finally:
+        if output is not sys.__stdout__:
+            output.close()
+    wall_time = time.perf_counter() - started
+    print(f"Answered {len(totals)} questions in {wall_time:.2f}s "
+          f"({len(totals) / wall_time:.1f}/s, {errors} errors)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
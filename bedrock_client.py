@@ -0,0 +1,49 @@
+import os
+import threading
+import boto3
+from botocore.config import Config
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BEDROCK_REGION = os.getenv("AWS_REGION", "us-east-1")
+# Point at mock_bedrock.py (e.g. http://localhost:8765) to run without AWS
+BEDROCK_ENDPOINT_URL = os.getenv("BEDROCK_ENDPOINT_URL") or None
+# Enough connections for every concurrent question plus the embedding workers
+BEDROCK_MAX_POOL_CONNECTIONS = int(os.getenv("BEDROCK_MAX_POOL_CONNECTIONS", 64))
+BEDROCK_CONNECT_TIMEOUT = float(os.getenv("BEDROCK_CONNECT_TIMEOUT", 5))
+BEDROCK_READ_TIMEOUT = float(os.getenv("BEDROCK_READ_TIMEOUT", 60))
+BEDROCK_MAX_ATTEMPTS = int(os.getenv("BEDROCK_MAX_ATTEMPTS", 4))
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def client_config() -> Config:
+    """botocore settings shared by every Bedrock call"""
+    return Config(
+        region_name=BEDROCK_REGION,
+        max_pool_connections=BEDROCK_MAX_POOL_CONNECTIONS,
+        tcp_keepalive=True,
+        connect_timeout=BEDROCK_CONNECT_TIMEOUT,
+        read_timeout=BEDROCK_READ_TIMEOUT,
+        # Adaptive mode adds client-side rate limiting on top of retrying throttled calls
+        retries={"max_attempts": BEDROCK_MAX_ATTEMPTS, "mode": "adaptive"}
+    )
+
+
+def get_bedrock_runtime():
+    """Get the process-wide bedrock-runtime client
+
+    boto3 clients are thread-safe, so the chat model and the embeddings share one
+    client and its pool of kept-alive connections instead of opening their own.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = boto3.session.Session().client(
+                "bedrock-runtime",
+                endpoint_url=BEDROCK_ENDPOINT_URL,
+                config=client_config()
+            )
+        return _client
@@ -0,0 +1,245 @@
+"""Offline benchmark for indexing and question answering.
+
+Runs the real rag/llm/graph code against deterministic stand-ins for the
+Bedrock embeddings and chat model, on synthetic catalogs generated from the
+files/data.json schema.
+
+    python benchmark.py --items 1000 10000 --queries 200 --concurrency 8
+    python benchmark.py --items 100000 --index-types flat hnsw ivfpq sq8
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Optional
+
+# Never reach AWS from the benchmark
+os.environ.setdefault("EMBEDDINGS_BACKEND", "stub")
+
+import numpy as np
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+import rag
+import llm
+from query_planner import query_planner
+from graph import app_graph
+from embedding_pipeline import StubEmbeddings
+
+SAMPLE_FILE = os.path.join("files", "data.json")
+
+
+class StubChatModel(BaseChatModel):
+    """Chat model stand-in that sleeps for a fixed latency and returns a canned JSON answer"""
+
+    latency: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub-chat"
+
+    def _generate(self, messages, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        if self.latency:
+            time.sleep(self.latency)
+        prompt_chars = sum(len(str(message.content)) for message in messages)
+        answer = json.dumps({"answer": "מצאתי מענים מתאימים לשאלתך", "maanim": ""}, ensure_ascii=False)
+        message = AIMessage(content=answer, usage_metadata={
+            "input_tokens": prompt_chars // 4, "output_tokens": len(answer) // 4,
+            "total_tokens": (prompt_chars + len(answer)) // 4
+        })
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def synthetic_catalog(items: int, seed: int = 0) -> List[dict]:
+    """Generate catalog items shaped like files/data.json, reusing its names and budgets"""
+    with open(SAMPLE_FILE, "r", encoding="utf-8") as f:
+        sample = json.load(f)
+    names = sorted({item["שם_מענה"] for item in sample})
+    budgets = sorted({budget.strip() for item in sample for budget in item.get("תקציבים", [])})
+    words = sorted({word for name in names for word in name.split()})
+    rng = random.Random(seed)
+    catalog = []
+    for i in range(items):
+        name = rng.choice(names) if i < len(names) else " ".join(rng.sample(words, rng.randint(2, 5)))
+        catalog.append({
+            "שם_מענה": name,
+            "קוד_מענה": 1000 + i,
+            "תקציבים": rng.sample(budgets, rng.randint(1, min(4, len(budgets))))
+        })
+    return catalog
+
+
+def synthetic_questions(catalog: List[dict], count: int, seed: int = 1) -> List[str]:
+    """Sample questions mixing service names, answer codes and free text"""
+    rng = random.Random(seed)
+    questions = []
+    for _ in range(count):
+        item = rng.choice(catalog)
+        kind = rng.random()
+        if kind < 0.2:
+            questions.append(f"מה זה מענה {item['קוד_מענה']}?")
+        elif kind < 0.6:
+            questions.append(f"אני מחפש {item['שם_מענה']}")
+        else:
+            questions.append(" ".join(rng.sample(item["שם_מענה"].split(), max(1, len(item["שם_מענה"].split()) // 2))))
+    return questions
+
+
+def latency_summary(latencies: List[float], wall_time: float) -> dict:
+    """p50/p95/p99 latency in ms and throughput"""
+    values = np.array(latencies) * 1000
+    return {
+        "count": len(latencies),
+        "p50_ms": round(float(np.percentile(values, 50)), 3),
+        "p95_ms": round(float(np.percentile(values, 95)), 3),
+        "p99_ms": round(float(np.percentile(values, 99)), 3),
+        "qps": round(len(latencies) / wall_time, 2) if wall_time else None
+    }
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
+
+
+def run_queries(func, questions: List[str], concurrency: int) -> dict:
+    """Run func over questions with the given concurrency and summarize latencies"""
+    def measure(question):
+        return timed(func, question)[1]
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            latencies = list(executor.map(measure, questions))
+    else:
+        latencies = [measure(question) for question in questions]
+    return latency_summary(latencies, time.perf_counter() - started)
+
+
+def benchmark_index_types(vectorstore, questions: List[str], index_types: List[str], k: int) -> List[dict]:
+    """Compare index types against the exact flat index: recall@k, search latency, build time and size"""
+    import faiss
+    vectors = rag.index_vectors(vectorstore)
+    queries = np.array([rag.cached_embeddings.embed_query(question) for question in questions], dtype="float32")
+    exact = rag.build_vector_index(vectors, "flat")
+    _, truth = exact.search(queries, k)
+    results = []
+    for index_type in index_types:
+        index, build_s = timed(rag.build_vector_index, vectors, index_type)
+        latencies, hits = [], 0
+        for query, expected in zip(queries, truth):
+            (_, found), elapsed = timed(index.search, query.reshape(1, -1), k)
+            latencies.append(elapsed)
+            hits += len(set(found[0]) & set(expected[expected >= 0]))
+        summary = latency_summary(latencies, sum(latencies))
+        results.append({
+            "index_type": index_type,
+            "index": rag.describe_index(index),
+            "build_s": round(build_s, 4),
+            "bytes": len(faiss.serialize_index(index)),
+            f"recall@{k}": round(hits / max(1, int((truth >= 0).sum())), 4),
+            "search_p50_ms": summary["p50_ms"],
+            "search_p99_ms": summary["p99_ms"]
+        })
+    return results
+
+
+def benchmark_catalog(items: int, args) -> dict:
+    """Build, persist, reload and query a synthetic catalog of the given size"""
+    work_dir = tempfile.mkdtemp(prefix="rag_bench_")
+    rag.VECTORSTORE_DIR = work_dir
+    data_file = os.path.join(work_dir, "data.json")
+    catalog = synthetic_catalog(items, args.seed)
+    with open(data_file, "w", encoding="utf-8") as f:
+        json.dump(catalog, f, ensure_ascii=False)
+
+    report = {"items": items}
+    documents, report["load_document_s"] = timed(rag.load_document, data_file)
+    vectorstore, report["create_vectorstore_s"] = timed(rag.create_vectorstore, documents)
+    _, report["save_vectorstore_s"] = timed(rag.save_vectorstore, vectorstore, "bench")
+    loaded, report["load_vectorstore_s"] = timed(rag.load_vectorstore, "bench")
+    report["chunks"] = loaded.index.ntotal
+    report["peak_rss_mb_after_build"] = round(peak_rss_mb(), 1)
+
+    catalog_questions = synthetic_questions(catalog, args.queries, args.seed)
+
+    def retrieve(question):
+        return llm.retrieve_documents({"question": question, "vectorstore": loaded, "user_info": llm.DEFAULT_USER_INFO})
+
+    def answer(question):
+        return app_graph.invoke({
+            "messages": [], "question": question, "vectorstore": loaded, "retrieved_docs": [],
+            "answer": "", "search_query": "", "sources": [], "user_info": llm.DEFAULT_USER_INFO
+        })
+
+    # Per-question debug prints would dominate the measured latency
+    with contextlib.redirect_stdout(sys.stdout if args.verbose else open(os.devnull, "w")):
+        # The metadata and lexical indexes are built lazily by the first search
+        _, report["first_query_s"] = timed(retrieve, catalog_questions[0])
+        report["retrieve"] = run_queries(retrieve, catalog_questions, args.concurrency)
+        report["graph_invoke"] = run_queries(answer, catalog_questions, args.concurrency)
+        if args.index_types:
+            report["index_types"] = benchmark_index_types(loaded, catalog_questions, args.index_types, args.k)
+    report["peak_rss_mb"] = round(peak_rss_mb(), 1)
+    shutil.rmtree(work_dir, ignore_errors=True)
+    for key, value in report.items():
+        if key.endswith("_s"):
+            report[key] = round(value, 4)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline RAG indexing and QA benchmark")
+    parser.add_argument("--items", type=int, nargs="+", default=[29, 1000, 10000], help="catalog sizes to benchmark")
+    parser.add_argument("--queries", type=int, default=200, help="questions per catalog")
+    parser.add_argument("--concurrency", type=int, default=1, help="concurrent questions")
+    parser.add_argument("--dimension", type=int, default=1536, help="stub embedding dimension")
+    parser.add_argument("--embed-latency", type=float, default=0.0, help="stub seconds per embedded text")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="stub seconds per generation")
+    parser.add_argument("--index-types", nargs="*", default=["flat", "hnsw", "ivfpq", "sq8"],
+                        help="vector index types to compare against the exact flat index")
+    parser.add_argument("--k", type=int, default=6, help="neighbours used for recall@k")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--verbose", action="store_true", help="keep per-question logging")
+    args = parser.parse_args()
+
+    stub_embeddings = StubEmbeddings(dimension=args.dimension, latency=args.embed_latency)
+    # Bypass the on-disk embedding cache so build times measure the embedding pipeline
+    rag.embeddings = stub_embeddings
+    rag.cached_embeddings = stub_embeddings
+    llm.model = StubChatModel(latency=args.llm_latency)
+    # Searches use the question as is instead of calling the rewrite model
+    query_planner.model = None
+
+    reports = []
+    for items in args.items:
+        print(f"=== Benchmarking catalog of {items} items ===")
+        report = benchmark_catalog(items, args)
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+        reports.append(report)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "reports": reports}, f, indent=2, ensure_ascii=False)
+        print(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
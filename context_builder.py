@@ -0,0 +1,102 @@
+import os
+import json
+from typing import List, Optional
+from langchain_core.documents import Document
+from rag import render_record
+
+# Token budget for the retrieved-documents part of the answer prompt
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 1500))
+# Rough characters per token for Hebrew text with Claude's tokenizer
+CHARS_PER_TOKEN = 3
+# Longest overlap the text splitter can leave between consecutive chunks
+MAX_CHUNK_OVERLAP = 200
+# Shorter common prefixes/suffixes are coincidence, not splitter overlap
+MIN_CHUNK_OVERLAP = 20
+# Skip a truncated tail shorter than this, it would add tokens without information
+MIN_TRUNCATED_CHARS = 80
+# Bump when the context format changes so cached answers built on the old format are dropped
+CONTEXT_VERSION = "2"
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate, good enough for budgeting"""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def _is_record(doc: Document) -> bool:
+    return bool(doc.metadata.get("record")) or doc.metadata.get("type") in ("json", "csv", "xlsx")
+
+
+def render_compact(doc: Document) -> str:
+    """Render a document for the prompt: records as one "field: value | ..." line, text as is"""
+    content = doc.page_content.strip()
+    if doc.metadata.get("type") == "json" and content.startswith("{"):
+        # Stores built before records were indexed compactly hold pretty-printed JSON
+        try:
+            item = json.loads(content)
+        except ValueError:
+            item = None
+        if isinstance(item, dict):
+            content = render_record(item)
+    if _is_record(doc):
+        return " | ".join(line.strip() for line in content.splitlines() if line.strip())
+    return content
+
+
+def _trim_overlap(previous: str, text: str) -> str:
+    """Drop the prefix of text that repeats the end of the previous chunk of the same record"""
+    for size in range(min(len(previous), len(text), MAX_CHUNK_OVERLAP), MIN_CHUNK_OVERLAP - 1, -1):
+        if previous.endswith(text[:size]):
+            return text[size:].lstrip()
+    return text
+
+
+def build_context(docs: List[Document], token_budget: Optional[int] = None) -> dict:
+    """Dedupe, compact and budget retrieved documents, keeping them in relevance order
+
+    Returns the context text plus token accounting against the naive join of every chunk.
+    """
+    token_budget = CONTEXT_TOKEN_BUDGET if token_budget is None else token_budget
+    seen = set()
+    last_chunk = {}
+    parts = []
+    used_tokens = 0
+    dropped = 0
+    for doc in docs:
+        text = render_compact(doc)
+        if not text or text in seen:
+            dropped += 1
+            continue
+        seen.add(text)
+        record_key = doc.metadata.get("record_key")
+        if record_key in last_chunk:
+            previous = last_chunk[record_key]
+            last_chunk[record_key] = text
+            text = _trim_overlap(previous, text)
+        else:
+            last_chunk[record_key] = text
+
+        tokens = estimate_tokens(text)
+        remaining = token_budget - used_tokens
+        if tokens > remaining:
+            # Records are kept whole and a smaller, less relevant one may still fit; text is truncated
+            remaining_chars = remaining * CHARS_PER_TOKEN
+            if _is_record(doc) or remaining_chars < MIN_TRUNCATED_CHARS:
+                dropped += 1
+                continue
+            text = text[:remaining_chars].rstrip() + "…"
+            tokens = estimate_tokens(text)
+        parts.append(text)
+        used_tokens += tokens
+
+    raw_tokens = estimate_tokens("\n\n".join(doc.page_content for doc in docs))
+    context = "\n".join(parts)
+    context_tokens = estimate_tokens(context)
+    return {
+        "context": context,
+        "docs_used": len(parts),
+        "docs_dropped": dropped,
+        "raw_tokens": raw_tokens,
+        "context_tokens": context_tokens,
+        "tokens_saved": max(0, raw_tokens - context_tokens)
+    }
@@ -0,0 +1,338 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from array import array
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from embedding_pipeline import StubEmbeddings, embed_in_batches
+
+EMBEDDING_CACHE_PATH = os.path.join("vectorDB", "embedding_cache.sqlite")
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+# Question vectors kept in memory, shared by every request
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", 4096))
+# How long the first uncached question waits for concurrent ones to share its embedding request, 0 disables
+QUERY_BATCH_WINDOW_MS = float(os.getenv("QUERY_BATCH_WINDOW_MS", 5))
+QUERY_BATCH_MAX = int(os.getenv("QUERY_BATCH_MAX", 32))
+# Cohere embeds at most this many texts per request
+COHERE_MAX_TEXTS = 96
+
+
+def normalize_query(text: str) -> str:
+    """Normalize question text so spellings that differ only in Unicode form or spacing share a vector"""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def embedding_key(model_id: str, text: str) -> str:
+    """Build cache key from the embedding model id and the chunk text"""
+    return hashlib.sha256(f"{model_id}\x00{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """On-disk SQLite store of embedding vectors with size-based LRU eviction"""
+
+    def __init__(self, path: str = EMBEDDING_CACHE_PATH, max_bytes: int = EMBEDDING_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                model_id TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON embeddings(last_used)")
+        self._conn.commit()
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+
+    def get_many(self, model_id: str, texts: List[str]) -> List[Optional[List[float]]]:
+        """Return cached vectors for texts, None where the text is not cached"""
+        keys = [embedding_key(model_id, text) for text in texts]
+        found: Dict[str, List[float]] = {}
+        with self._lock:
+            unique_keys = list(set(keys))
+            # SQLite limits the number of bound parameters per statement
+            for start in range(0, len(unique_keys), 500):
+                batch = unique_keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = array("f", blob).tolist()
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found]
+                )
+                self._conn.commit()
+            results = [found.get(key) for key in keys]
+            hits = sum(1 for vector in results if vector is not None)
+            self.hits += hits
+            self.misses += len(results) - hits
+        return results
+
+    def put_many(self, model_id: str, texts: List[str], vectors: List[List[float]]):
+        """Store vectors for texts and evict least recently used entries over the size limit"""
+        now = time.time()
+        rows = {}
+        for text, vector in zip(texts, vectors):
+            blob = array("f", vector).tobytes()
+            rows[embedding_key(model_id, text)] = (model_id, blob, len(blob))
+        with self._lock:
+            for key, (row_model_id, blob, size) in rows.items():
+                previous = self._conn.execute("SELECT size FROM embeddings WHERE key = ?", (key,)).fetchone()
+                if previous:
+                    self._total_bytes -= previous[0]
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO embeddings (key, model_id, vector, size, last_used) VALUES (?, ?, ?, ?, ?)",
+                    (key, row_model_id, blob, size, now)
+                )
+                self._total_bytes += size
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """Drop least recently used entries until the cache is under its byte budget"""
+        if self._total_bytes <= self.max_bytes:
+            return
+        # Evict down to 90% so we don't evict again on every insert
+        target = int(self.max_bytes * 0.9)
+        rows = self._conn.execute("SELECT key, size FROM embeddings ORDER BY last_used ASC").fetchall()
+        evicted = []
+        for key, size in rows:
+            if self._total_bytes <= target:
+                break
+            evicted.append((key,))
+            self._total_bytes -= size
+        self._conn.executemany("DELETE FROM embeddings WHERE key = ?", evicted)
+        self.evictions += len(evicted)
+
+    def stats(self) -> dict:
+        """Get cache counters"""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "entries": entries,
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+
+class QueryEmbeddingCache:
+    """In-memory LRU of question vectors keyed by model id and normalized question"""
+
+    def __init__(self, max_entries: int = QUERY_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, model_id: str, text: str) -> Optional[List[float]]:
+        key = embedding_key(model_id, text)
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return vector
+
+    def put(self, model_id: str, text: str, vector: List[float]):
+        key = embedding_key(model_id, text)
+        with self._lock:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+
+class QueryEncoder(Embeddings):
+    """Embeds questions in query mode, many per request where the model allows it"""
+
+    def __init__(self, underlying: Embeddings):
+        self.underlying = underlying
+
+    @property
+    def batches_requests(self) -> bool:
+        # Titan embeds one text per request, so grouping its questions would only serialize them
+        return self._is_cohere or isinstance(self.underlying, StubEmbeddings)
+
+    @property
+    def _is_cohere(self) -> bool:
+        return getattr(self.underlying, "provider", None) == "cohere"
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self._is_cohere:
+            return self._embed_cohere(texts)
+        if isinstance(self.underlying, StubEmbeddings):
+            return self.underlying.embed_documents(texts)
+        return [self.underlying.embed_query(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.underlying.embed_query(text)
+
+    def _embed_cohere(self, texts: List[str]) -> List[List[float]]:
+        """Embed up to COHERE_MAX_TEXTS questions per InvokeModel call
+
+        BedrockEmbeddings.embed_documents would embed them with the "search_document" input type.
+        """
+        vectors = []
+        for start in range(0, len(texts), COHERE_MAX_TEXTS):
+            body = {**(self.underlying.model_kwargs or {}), "input_type": "search_query",
+                    "texts": texts[start:start + COHERE_MAX_TEXTS]}
+            response = self.underlying.client.invoke_model(
+                body=json.dumps(body), modelId=self.underlying.model_id,
+                accept="application/json", contentType="application/json"
+            )
+            vectors += json.loads(response["body"].read())["embeddings"]
+        if self.underlying.normalize:
+            vectors = [(np.array(vector) / np.linalg.norm(vector)).tolist() for vector in vectors]
+        return vectors
+
+
+class QueryBatcher:
+    """Groups questions embedded concurrently into one request
+
+    The first caller waits up to the window for others to join, then embeds the whole group;
+    callers asking for a question that is already pending or in flight share its result.
+    """
+
+    def __init__(self, embed_many: Callable[[List[str]], List[List[float]]],
+                 window_ms: float = QUERY_BATCH_WINDOW_MS, max_batch: int = QUERY_BATCH_MAX):
+        self.embed_many = embed_many
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.requests = 0
+        self.embedded = 0
+        self.largest_batch = 0
+        self._futures: Dict[str, Future] = {}
+        self._batch: List[str] = []
+        self._full = threading.Event()
+        self._lock = threading.Lock()
+
+    def embed(self, text: str) -> List[float]:
+        leader = False
+        with self._lock:
+            future = self._futures.get(text)
+            if future is None:
+                future = self._futures[text] = Future()
+                self._batch.append(text)
+                leader = len(self._batch) == 1
+                if len(self._batch) >= self.max_batch:
+                    self._full.set()
+        if leader:
+            self._flush()
+        return future.result()
+
+    def _flush(self):
+        if self.window > 0:
+            self._full.wait(self.window)
+        with self._lock:
+            texts, self._batch = self._batch, []
+            self._full.clear()
+            futures = [self._futures[text] for text in texts]
+            self.requests += 1
+            self.embedded += len(texts)
+            self.largest_batch = max(self.largest_batch, len(texts))
+        try:
+            vectors = self.embed_many(texts)
+            for future, vector in zip(futures, vectors):
+                future.set_result(vector)
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+        finally:
+            with self._lock:
+                for text in texts:
+                    self._futures.pop(text, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"requests": self.requests, "embedded": self.embedded, "largest_batch": self.largest_batch,
+                    "window_ms": self.window * 1000}
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper that only calls the underlying model for uncached chunks and questions"""
+
+    def __init__(self, underlying: Embeddings, cache: EmbeddingCache, model_id: str,
+                 query_cache: Optional[QueryEmbeddingCache] = None):
+        self.underlying = underlying
+        self.cache = cache
+        self.model_id = model_id
+        self.query_cache = query_cache or QueryEmbeddingCache()
+        self.query_encoder = QueryEncoder(underlying)
+        window_ms = QUERY_BATCH_WINDOW_MS if self.query_encoder.batches_requests else 0
+        self.query_batcher = QueryBatcher(self.query_encoder.embed_documents, window_ms)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = self.cache.get_many(self.model_id, texts)
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        if missing:
+            cached = sum(1 for vector in vectors if vector is not None)
+            print(f"Embedding cache: {cached} cached, embedding {len(missing)} new chunks")
+            new_vectors = self.underlying.embed_documents(missing)
+            self.cache.put_many(self.model_id, missing, new_vectors)
+            by_text = dict(zip(missing, new_vectors))
+            vectors = [vector if vector is not None else by_text[text] for text, vector in zip(texts, vectors)]
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        text = normalize_query(text)
+        vector = self.query_cache.get(self.model_id, text)
+        if vector is None:
+            vector = self.query_batcher.embed(text)
+            self.query_cache.put(self.model_id, text, vector)
+        return vector
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """Embed many questions at once, reusing and filling the query cache"""
+        texts = [normalize_query(text) for text in texts]
+        vectors = [self.query_cache.get(self.model_id, text) for text in texts]
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        if missing:
+            by_text = {}
+            for start, batch_vectors in embed_in_batches(self.query_encoder, missing):
+                by_text.update(zip(missing[start:start + len(batch_vectors)], batch_vectors))
+            for text, vector in by_text.items():
+                self.query_cache.put(self.model_id, text, vector)
+            vectors = [vector if vector is not None else by_text[text] for text, vector in zip(texts, vectors)]
+        return vectors
+
+    def query_stats(self) -> dict:
+        return {**self.query_cache.stats(), "batching": self.query_batcher.stats()}
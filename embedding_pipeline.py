@@ -0,0 +1,132 @@
+import os
+import time
+import random
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Iterator, List, Optional, Tuple
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_community.vectorstores import FAISS
+
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 16))
+EMBED_MAX_WORKERS = int(os.getenv("EMBED_MAX_WORKERS", 4))
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", 6))
+EMBED_BACKOFF_BASE = float(os.getenv("EMBED_BACKOFF_BASE", 0.5))
+EMBED_BACKOFF_MAX = float(os.getenv("EMBED_BACKOFF_MAX", 20))
+
+THROTTLING_MARKERS = ("ThrottlingException", "TooManyRequests", "Too many requests",
+                      "ServiceUnavailable", "Rate exceeded")
+
+
+class StubEmbeddings(Embeddings):
+    """Deterministic offline embeddings derived from a hash of the text"""
+
+    def __init__(self, dimension: int = 1536, latency: float = 0.0):
+        self.dimension = dimension
+        self.latency = latency
+
+    def _vector(self, text: str) -> List[float]:
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.dimension).astype("float32")
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.latency:
+            time.sleep(self.latency * len(texts))
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        if self.latency:
+            time.sleep(self.latency)
+        return self._vector(text)
+
+
+def is_throttling_error(error: Exception) -> bool:
+    """Check if an embeddings error is a rate limit / capacity error worth retrying"""
+    response = getattr(error, "response", None)
+    code = response.get("Error", {}).get("Code", "") if isinstance(response, dict) else ""
+    message = f"{code} {error}"
+    return any(marker in message for marker in THROTTLING_MARKERS)
+
+
+class _ThrottleGate:
+    """Shared pause so every worker backs off once any worker gets throttled"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._resume_at = 0.0
+
+    def wait(self):
+        delay = self._resume_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+
+
+def embed_with_retry(embeddings: Embeddings, texts: List[str], gate: Optional[_ThrottleGate] = None) -> List[List[float]]:
+    """Embed a batch, retrying throttling errors with jittered exponential backoff"""
+    gate = gate or _ThrottleGate()
+    for attempt in range(EMBED_MAX_RETRIES + 1):
+        gate.wait()
+        try:
+            return embeddings.embed_documents(texts)
+        except Exception as e:
+            if attempt == EMBED_MAX_RETRIES or not is_throttling_error(e):
+                raise
+            delay = random.uniform(0, min(EMBED_BACKOFF_MAX, EMBED_BACKOFF_BASE * 2 ** attempt))
+            print(f"Embeddings throttled, retrying batch of {len(texts)} in {delay:.2f}s")
+            gate.pause(delay)
+
+
+def embed_in_batches(embeddings: Embeddings, texts: List[str], batch_size: int = EMBED_BATCH_SIZE,
+                     max_workers: int = EMBED_MAX_WORKERS) -> Iterator[Tuple[int, List[List[float]]]]:
+    """Embed texts concurrently and yield (start offset, vectors) as each batch finishes"""
+    gate = _ThrottleGate()
+    starts = iter(range(0, len(texts), batch_size))
+    # Keep a bounded number of batches in flight so slow responses apply backpressure
+    max_in_flight = max_workers * 2
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = {}
+        for start in starts:
+            in_flight[executor.submit(embed_with_retry, embeddings, texts[start:start + batch_size], gate)] = start
+            if len(in_flight) >= max_in_flight:
+                break
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                start = in_flight.pop(future)
+                yield start, future.result()
+                next_start = next(starts, None)
+                if next_start is not None:
+                    batch = texts[next_start:next_start + batch_size]
+                    in_flight[executor.submit(embed_with_retry, embeddings, batch, gate)] = next_start
+
+
+def add_documents_concurrently(vectorstore: Optional[FAISS], documents: List[Document], embeddings: Embeddings,
+                               batch_size: int = EMBED_BATCH_SIZE, max_workers: int = EMBED_MAX_WORKERS,
+                               progress: Optional[Callable[[int, int], None]] = None) -> FAISS:
+    """Embed documents with the batched pipeline and stream the vectors into a FAISS index"""
+    texts = [doc.page_content for doc in documents]
+    started = time.perf_counter()
+    embedded = 0
+    for start, vectors in embed_in_batches(embeddings, texts, batch_size, max_workers):
+        batch = documents[start:start + len(vectors)]
+        text_embeddings = list(zip(texts[start:start + len(vectors)], vectors))
+        metadatas = [doc.metadata for doc in batch]
+        ids = [doc.id for doc in batch] if all(doc.id for doc in batch) else None
+        if vectorstore is None:
+            vectorstore = FAISS.from_embeddings(text_embeddings, embeddings, metadatas=metadatas, ids=ids)
+        else:
+            vectorstore.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+        embedded += len(vectors)
+        if progress:
+            progress(embedded, len(documents))
+    elapsed = time.perf_counter() - started
+    if embedded:
+        print(f"Embedded {embedded} chunks in {elapsed:.2f}s ({embedded / elapsed:.1f} chunks/s)")
+    return vectorstore
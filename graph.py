@@ -1,18 +1,31 @@
 
 from langgraph.graph import StateGraph, END
 from graph_state import AgentState
-from llm import retrieve_documents, generate_answer,process_user_query
+from llm import (merge_retrieval, generate_answer, process_user_query, route_answer,
+                 RETRIEVAL_BRANCHES, TEMPLATED_ANSWERS)
+from tracing import traced_node
 
 
 def create_workflow():
     workflow = StateGraph(AgentState)
-    workflow.add_node("retrieve", retrieve_documents)
-    workflow.add_node("generate", generate_answer)
-    workflow.add_node("process_query", process_user_query)
+    # Every node is wrapped to record its wall time for /api/metrics
+    # Retrieval fans out into independent searches that run concurrently and are merged by "retrieve"
+    for name, branch in RETRIEVAL_BRANCHES.items():
+        workflow.add_node(name, traced_node(name, branch))
+    workflow.add_node("retrieve", traced_node("retrieve", merge_retrieval))
+    workflow.add_node("generate", traced_node("generate", generate_answer))
+    for name, answer in TEMPLATED_ANSWERS.items():
+        workflow.add_node(name, traced_node(name, answer))
+    workflow.add_node("process_query", traced_node("process_query", process_user_query))
     workflow.set_entry_point("process_query")
-    workflow.add_edge("process_query", "retrieve")
-    workflow.add_edge("retrieve", "generate")
-    workflow.add_edge("generate", END)
+    for name in RETRIEVAL_BRANCHES:
+        workflow.add_edge("process_query", name)
+    workflow.add_edge(list(RETRIEVAL_BRANCHES), "retrieve")
+    # Empty results and single exact code matches are answered from templates, skipping the LLM
+    routes = {"generate": "generate", **{name: name for name in TEMPLATED_ANSWERS}}
+    workflow.add_conditional_edges("retrieve", route_answer, routes)
+    for name in routes:
+        workflow.add_edge(name, END)
     return workflow.compile()
 
 app_graph = create_workflow()
\ No newline at end of file
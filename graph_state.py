@@ -1,9 +1,14 @@
-from typing import Annotated, Dict, List, Sequence, TypedDict
+from typing import Annotated, Dict, List, Optional, Sequence, TypedDict
 from langchain_core.documents import Document
 from langchain_core.messages import BaseMessage
 from langgraph.graph.message import add_messages
 
 
+def merge_branches(left: Dict[str, dict], right: Dict[str, dict]) -> Dict[str, dict]:
+    """Reducer for parallel retrieval branches, each writing its own entry"""
+    return {**(left or {}), **(right or {})}
+
+
 class AgentState(TypedDict):
     messages: Annotated[Sequence[BaseMessage], add_messages]
     question: str
@@ -13,3 +18,9 @@ class AgentState(TypedDict):
     answer: str
     sources: List[str]
     user_info:str
+    query_embedding: Optional[List[float]]
+    query_filters: Dict[str, object]
+    # Results of the parallel retrieval branches by branch name, merged by the retrieve node
+    retrieval_branches: Annotated[Dict[str, dict], merge_branches]
+    # Set when every vector search failed, so an empty result is not mistaken for "no matches"
+    retrieval_error: Optional[str]
@@ -0,0 +1,267 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from itertools import islice
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from langchain_core.documents import Document
+from langchain_community.vectorstores import FAISS
+from rag import (create_vectorstore_from_batches, get_file_hash, iter_documents, iter_document_batches, iter_batches,
+                 load_vectorstore, save_vectorstore, supports_incremental_update, update_vectorstore,
+                 clone_vectorstore, load_manifest, delete_vectorstore, LOAD_BATCH_SIZE)
+
+# Configuration
+FILES_DIR = "files"
+SUPPORTED_EXTENSIONS = ['.xlsx', '.csv', '.txt', '.json']
+MAX_FINISHED_JOBS = 100
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", min(4, os.cpu_count() or 1)))
+# Files above this size are streamed in-process instead of parsed whole by a worker
+STREAM_FILE_BYTES = int(os.getenv("STREAM_FILE_BYTES", 64 * 1024 * 1024))
+
+
+def find_data_files(files_dir: str = FILES_DIR) -> List[str]:
+    """List every supported file under the files directory, including subdirectories"""
+    data_files = []
+    for root, dirs, files in os.walk(files_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for name in sorted(files):
+            if not name.startswith(".") and os.path.splitext(name)[1].lower() in SUPPORTED_EXTENSIONS:
+                data_files.append(os.path.join(root, name))
+    return data_files
+
+
+def scan_corpus(files_dir: str = FILES_DIR) -> Tuple[Dict[str, str], str]:
+    """Build the corpus manifest (relative path -> file hash) and a hash identifying the whole corpus"""
+    manifest = {
+        os.path.relpath(path, files_dir).replace(os.sep, "/"): get_file_hash(path)
+        for path in find_data_files(files_dir)
+    }
+    corpus_hash = hashlib.md5(json.dumps(manifest, sort_keys=True).encode("utf-8")).hexdigest() if manifest else ""
+    return manifest, corpus_hash
+
+
+def _load_source(args: Tuple[str, str]) -> List[Document]:
+    file_path, source = args
+    return list(iter_documents(file_path, source))
+
+
+def iter_source_batches(files_dir: str, sources: List[str]) -> Iterator[List[Document]]:
+    """Stream document batches from corpus files
+
+    Small files are parsed in parallel worker processes, a few at a time; files over
+    STREAM_FILE_BYTES are streamed record by record so memory stays flat however big they are.
+    """
+    tasks = [(os.path.join(files_dir, source), source) for source in sources]
+    pooled = [task for task in tasks if os.path.getsize(task[0]) <= STREAM_FILE_BYTES]
+    if len(pooled) <= 1 or PARSE_WORKERS <= 1:
+        pooled = []
+    streamed = [task for task in tasks if task not in pooled]
+    if pooled:
+        with ProcessPoolExecutor(max_workers=min(PARSE_WORKERS, len(pooled))) as executor:
+            pending = iter(pooled)
+            # Bound the parsed files held in memory while the embedding stage catches up
+            in_flight = deque(executor.submit(_load_source, task) for task in islice(pending, PARSE_WORKERS))
+            while in_flight:
+                documents = in_flight.popleft().result()
+                next_task = next(pending, None)
+                if next_task:
+                    in_flight.append(executor.submit(_load_source, next_task))
+                yield from iter_batches(documents, LOAD_BATCH_SIZE)
+    for file_path, source in streamed:
+        yield from iter_document_batches(file_path, source)
+
+
+class IndexJob:
+    """Progress of one background vectorstore build"""
+
+    def __init__(self, manifest: Dict[str, str], file_hash: str):
+        self.id = uuid.uuid4().hex
+        self.manifest = manifest
+        self.file_hash = file_hash
+        self.status = "queued"
+        self.stage = "queued"
+        self.progress = {}
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def update(self, stage: str, **progress):
+        self.stage = stage
+        self.progress = progress
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("succeeded", "failed")
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "stage": self.stage,
+            "progress": self.progress,
+            "files": sorted(self.manifest),
+            "file_hash": self.file_hash,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "duration_seconds": round(self.finished_at - self.started_at, 3) if self.finished_at and self.started_at else None
+        }
+
+
+class IndexManager:
+    """Owns the serving vectorstore and rebuilds it in the background, swapping atomically when done"""
+
+    def __init__(self, files_dir: str = FILES_DIR):
+        self.files_dir = files_dir
+        self._lock = threading.Lock()
+        self._vectorstore: Optional[FAISS] = None
+        self._file_hash: Optional[str] = None
+        self._manifest: Optional[Dict[str, str]] = None
+        self._jobs: "OrderedDict[str, IndexJob]" = OrderedDict()
+        # A single worker keeps builds serialized so two rebuilds never race on the same swap
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="indexer")
+        self._swap_listeners: List[Callable[[FAISS, str], None]] = []
+
+    def snapshot(self) -> Tuple[Optional[FAISS], Optional[str]]:
+        """Get the serving vectorstore and its file hash as a consistent pair"""
+        with self._lock:
+            return self._vectorstore, self._file_hash
+
+    def on_swap(self, listener: Callable[[FAISS, str], None]):
+        """Register a callback run after a new vectorstore starts serving"""
+        self._swap_listeners.append(listener)
+
+    def manifest(self) -> Optional[Dict[str, str]]:
+        """Source files and hashes the serving vectorstore was built from"""
+        with self._lock:
+            return self._manifest
+
+    def swap(self, vectorstore: FAISS, file_hash: str, manifest: Optional[Dict[str, str]] = None):
+        """Atomically replace the serving vectorstore and delete the saved store it supersedes"""
+        if manifest is None:
+            manifest = load_manifest(file_hash)
+        with self._lock:
+            previous_hash = self._file_hash
+            self._vectorstore = vectorstore
+            self._file_hash = file_hash
+            self._manifest = manifest
+        for listener in self._swap_listeners:
+            listener(vectorstore, file_hash)
+        print(f"Serving vectorstore {file_hash}")
+        # Every rebuild saves a complete store, so without this each catalog edit would leave one behind
+        if previous_hash and previous_hash != file_hash:
+            delete_vectorstore(previous_hash)
+
+    def build(self, manifest: Dict[str, str], file_hash: str, job: Optional[IndexJob] = None) -> Optional[FAISS]:
+        """Load the vectorstore for a corpus hash, or build it from the files that changed"""
+        def report(stage, **progress):
+            if job:
+                job.update(stage, **progress)
+
+        # Try to load existing vectorstore
+        report("loading saved vectorstore")
+        vectorstore = load_vectorstore(file_hash)
+        if vectorstore is not None:
+            return vectorstore
+
+        def embedding_progress(embedded, total):
+            report("embedding", embedded=embedded, total=total)
+
+        current_vectorstore, _ = self.snapshot()
+        current_manifest = self.manifest()
+        if current_vectorstore and supports_incremental_update(current_vectorstore):
+            if current_manifest is not None:
+                # Only parse and re-embed files whose hash changed; records of removed files are dropped
+                changed = [source for source, source_hash in manifest.items() if current_manifest.get(source) != source_hash]
+                removed = [source for source in current_manifest if source not in manifest]
+                sources = set(changed + removed)
+            else:
+                changed = list(manifest)
+                sources = None
+            report("loading documents", files=len(changed))
+            print(f"Loading and processing {len(changed)} changed files...")
+            documents = (doc for batch in iter_source_batches(self.files_dir, changed) for doc in batch)
+            # Queries keep using the serving index, which may also be memory-mapped, so update a copy;
+            # the copy is saved below as a complete new store rather than as a delta against the old one
+            print("Updating vectorstore incrementally...")
+            report("copying serving vectorstore")
+            vectorstore = clone_vectorstore(current_vectorstore)
+            update_vectorstore(vectorstore, documents, progress=embedding_progress, sources=sources)
+            if vectorstore.index.ntotal == 0:
+                return None
+        else:
+            report("loading documents", files=len(manifest))
+            print(f"Loading and processing {len(manifest)} files...")
+            # Batches are embedded as they are parsed instead of loading the whole corpus first
+            print("Creating vectorstore...")
+            batches = iter_source_batches(self.files_dir, list(manifest))
+            vectorstore = create_vectorstore_from_batches(batches, progress=embedding_progress)
+            if vectorstore is None:
+                return None
+
+        # Save vectorstore
+        report("saving")
+        if not save_vectorstore(vectorstore, file_hash, manifest):
+            raise RuntimeError("Could not save vectorstore")
+        return vectorstore
+
+    def submit(self, manifest: Dict[str, str], file_hash: str) -> IndexJob:
+        """Queue a background build, reusing a pending job for the same corpus hash"""
+        with self._lock:
+            for job in self._jobs.values():
+                if job.file_hash == file_hash and not job.finished:
+                    return job
+            job = IndexJob(manifest, file_hash)
+            self._jobs[job.id] = job
+            self._prune_jobs()
+        self._executor.submit(self._run, job)
+        return job
+
+    def _run(self, job: IndexJob):
+        job.status = "running"
+        job.started_at = time.time()
+        try:
+            if self.snapshot()[1] == job.file_hash:
+                job.update("already serving")
+            else:
+                vectorstore = self.build(job.manifest, job.file_hash, job)
+                if vectorstore is None:
+                    raise ValueError("Could not load the files")
+                # Only swap once the new index is fully built and persisted
+                job.update("swapping")
+                self.swap(vectorstore, job.file_hash, job.manifest)
+                job.update("done")
+            job.status = "succeeded"
+        except Exception as e:
+            print(f"Error building vectorstore: {e}")
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
+
+    def _prune_jobs(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(self._jobs) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+
+    def get_job(self, job_id: str) -> Optional[IndexJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def wait(self, job: IndexJob, timeout: Optional[float] = None) -> bool:
+        """Block until a job finishes or the timeout expires"""
+        deadline = time.monotonic() + timeout if timeout else None
+        while not job.finished:
+            if deadline and time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+
+index_manager = IndexManager()
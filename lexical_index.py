@@ -0,0 +1,132 @@
+import re
+import math
+import threading
+import unicodedata
+import weakref
+from collections import Counter
+from typing import Dict, List, Optional, Sequence
+import numpy as np
+from langchain_community.vectorstores import FAISS
+
+# Single-letter Hebrew prefixes (ו/ה/ב/ל/מ/ש) that attach to the following word
+HEBREW_PREFIXES = "והבלמש"
+HEBREW_WORD = re.compile(r"^[א-ת]+$")
+CODE_PATTERN = re.compile(r"(?<!\d)\d{2,}(?!\d)")
+BM25_K1 = 1.5
+BM25_B = 0.75
+RRF_K = 60
+
+
+def hebrew_variants(token: str) -> List[str]:
+    """Return the token plus forms with up to two leading Hebrew prefixes stripped"""
+    variants = [token]
+    if HEBREW_WORD.match(token):
+        stripped = token
+        # Keep at least three letters so short words aren't reduced to noise
+        for _ in range(2):
+            if len(stripped) > 3 and stripped[0] in HEBREW_PREFIXES:
+                stripped = stripped[1:]
+                variants.append(stripped)
+            else:
+                break
+    return variants
+
+
+def tokenize(text: str) -> List[str]:
+    """Tokenize Hebrew/English text for lexical matching"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    # Drop niqqud and cantillation marks
+    text = re.sub(r"[\u0591-\u05C7]", "", text)
+    tokens = []
+    for token in re.findall(r"\w+", text):
+        token = token.replace("_", "")
+        if token:
+            tokens.extend(hebrew_variants(token))
+    return tokens
+
+
+class LexicalIndex:
+    """BM25 inverted index over vectorstore documents with exact answer-code lookup"""
+
+    def __init__(self, vectorstore: FAISS):
+        self.doc_ids: List[str] = []
+        self.postings: Dict[str, Dict[int, int]] = {}
+        self.codes: Dict[str, List[int]] = {}
+        lengths = []
+        for position in range(len(vectorstore.index_to_docstore_id)):
+            doc_id = vectorstore.index_to_docstore_id[position]
+            doc = vectorstore.docstore._dict.get(doc_id)
+            text = doc.page_content if doc else ""
+            counts = Counter(tokenize(text))
+            for term, count in counts.items():
+                self.postings.setdefault(term, {})[position] = count
+            lengths.append(sum(counts.values()))
+            self.doc_ids.append(doc_id)
+            code = doc.metadata.get("קוד_מענה") if doc else None
+            if code is not None:
+                self.codes.setdefault(str(code), []).append(position)
+        self.lengths = np.array(lengths, dtype="float32")
+        self.average_length = float(self.lengths.mean()) if len(lengths) else 0.0
+        self.ntotal = vectorstore.index.ntotal
+
+    def code_matches(self, query: str, allowed: Optional[np.ndarray] = None) -> List[str]:
+        """Docstore ids of documents whose answer code appears literally in the query"""
+        positions = []
+        for code in CODE_PATTERN.findall(query):
+            positions.extend(self.codes.get(code, []))
+        if allowed is not None:
+            allowed_set = set(allowed.tolist())
+            positions = [position for position in positions if position in allowed_set]
+        return [self.doc_ids[position] for position in dict.fromkeys(positions)]
+
+    def search(self, query: str, k: int, allowed: Optional[np.ndarray] = None) -> List[str]:
+        """Rank documents by BM25 and return the top k docstore ids"""
+        if not self.doc_ids:
+            return []
+        scores = np.zeros(len(self.doc_ids), dtype="float32")
+        total = len(self.doc_ids)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+            positions = np.fromiter(postings.keys(), dtype="int64")
+            frequencies = np.fromiter(postings.values(), dtype="float32")
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[positions] / (self.average_length or 1))
+            scores[positions] += idf * frequencies * (BM25_K1 + 1) / (frequencies + norm)
+        if allowed is not None:
+            mask = np.zeros(len(scores), dtype=bool)
+            mask[allowed] = True
+            scores[~mask] = 0
+        candidates = np.nonzero(scores)[0]
+        ranked = candidates[np.argsort(-scores[candidates], kind="stable")][:k]
+        return [self.doc_ids[position] for position in ranked]
+
+
+def reciprocal_rank_fusion(rankings: Sequence[List[str]], k: int = RRF_K) -> List[str]:
+    """Fuse ranked id lists by summing 1 / (k + rank) per list"""
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=lambda doc_id: scores[doc_id], reverse=True)
+
+
+_indexes = weakref.WeakKeyDictionary()
+_indexes_lock = threading.Lock()
+
+
+def get_lexical_index(vectorstore: FAISS) -> LexicalIndex:
+    """Get the lexical index for a vectorstore, building it on first use"""
+    with _indexes_lock:
+        lexical_index = _indexes.get(vectorstore)
+        if lexical_index is None or lexical_index.ntotal != vectorstore.index.ntotal:
+            lexical_index = LexicalIndex(vectorstore)
+            _indexes[vectorstore] = lexical_index
+        return lexical_index
+
+
+def invalidate_lexical_index(vectorstore: FAISS):
+    """Drop the cached lexical index after the vectorstore changes"""
+    with _indexes_lock:
+        _indexes.pop(vectorstore, None)
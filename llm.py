@@ -1,98 +1,272 @@
 import os
 import json
+import hashlib
 from datetime import datetime
 # import pandas as pd
 from pathlib import Path
-from typing import List
+from typing import Dict, List, Optional, Tuple
+import numpy as np
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from dotenv import load_dotenv
 from langchain_community.vectorstores import FAISS
 from graph_state import AgentState
+from metadata_index import get_metadata_index
+from lexical_index import get_lexical_index, reciprocal_rank_fusion, CODE_PATTERN
+from context_builder import build_context, render_compact, CONTEXT_VERSION
+from tracing import record_context, record_route
+from query_planner import query_planner
 from langchain_aws import ChatBedrock
+from bedrock_client import get_bedrock_runtime, BEDROCK_REGION
 from langchain_core.documents import Document
 import re
 
 load_dotenv()
 
+LLM_MODEL_ID = os.getenv("LLM_MODEL_ID", "anthropic.claude-3-5-sonnet-20240620-v1:0")
+# Models Bedrock supports prompt caching for; inference profile ids ("us.anthropic...") match too
+PROMPT_CACHE_MODELS = ("anthropic.claude-3-7-sonnet", "anthropic.claude-3-5-haiku", "anthropic.claude-sonnet-4",
+                       "anthropic.claude-opus-4", "amazon.nova")
+# BEDROCK_PROMPT_CACHING=1/0 forces it on or off, otherwise it follows the model
+PROMPT_CACHING = os.getenv("BEDROCK_PROMPT_CACHING", "1" if any(m in LLM_MODEL_ID for m in PROMPT_CACHE_MODELS) else "0") == "1"
+
 try:
     model = ChatBedrock(
-        model_id="anthropic.claude-3-5-sonnet-20240620-v1:0",
+        model_id=LLM_MODEL_ID,
         model_kwargs={"temperature": 0},
-        region_name=os.getenv("AWS_REGION", "us-east-1")
+        region_name=BEDROCK_REGION,
+        client=get_bedrock_runtime(),
+        # Only the Converse API accepts cache points inside the system prompt
+        beta_use_converse_api=PROMPT_CACHING
 )
 except Exception as e:
     print(f"Error initializing AWS Bedrock: {e}")
     model = None
 
-def retrieve_documents(state: AgentState) -> AgentState:
-    """Retrieve relevant documents from vectorstore with metadata filtering"""
-    question = state["question"]
-    vectorstore = state["vectorstore"]
+POPULATION_FILTER = {"אוכלוסיה": "מוסד"}
+# Budgets assumed for the asking user until they come from the request
+DEFAULT_USER_INFO = ["סל תשתיות בית ספריות", "סל מנהיגות חינוכית", "סל חינוך חברתי - קהילתי והעשרה", "סל אוכלוסיות במיקוד"]
+RETRIEVAL_K = 6
+# Fuse BM25 and exact answer-code matches with the vector results
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "1") == "1"
+
+def user_budget_names(user_info) -> List[str]:
+    """Normalize the user's budgets ("12 סל ..." or just the name) to budget names"""
+    if isinstance(user_info, str):
+        user_info = user_info.split(",")
+    names = []
+    for budget in user_info or []:
+        name = re.sub(r"^\d+\s+", "", str(budget).strip())
+        if name and name not in names:
+            names.append(name)
+    return names
+
+def search_filters(user_info, query_filters: dict = None) -> List[dict]:
+    """Metadata filters to try in priority order: population and budgets first, unfiltered last"""
+    budget_names = user_budget_names(user_info)
+    query_filters = query_filters or {}
+    # A population named in the question replaces the default one
+    population_filter = {"אוכלוסיה": query_filters["אוכלוסיה"]} if query_filters.get("אוכלוסיה") else POPULATION_FILTER
+    asked_budgets = [name for name in query_filters.get("שם_תקציב", []) if name in budget_names]
+    filters = []
+    if asked_budgets:
+        # Budgets named in the question narrow the user's budgets
+        filters.append({**population_filter, "שם_תקציב": asked_budgets})
+    if budget_names:
+        # Only answers purchasable with one of the user's budgets
+        filters.append({**population_filter, "שם_תקציב": budget_names})
+        filters.append({"שם_תקציב": budget_names})
+    filters.append(population_filter)
+    filters.append(None)
+    return filters
+
+def search_documents(vectorstore: FAISS, query_embedding: List[float], k: int = 6, filter: dict = None) -> List[Document]:
+    """Similarity search restricted to the rows matching the metadata filter before scoring"""
+    results = get_metadata_index(vectorstore).search(vectorstore, query_embedding, k, filter)
+    return [doc for doc, _ in results]
+
+def lexical_candidates(vectorstore: FAISS, query: str, allowed_ids, k: int = RETRIEVAL_K) -> Tuple[List[str], List[str]]:
+    """Docstore ids of exact answer-code matches and of the top BM25 results"""
+    lexical_index = get_lexical_index(vectorstore)
+    return lexical_index.code_matches(query, allowed_ids), lexical_index.search(query, k, allowed_ids)
+
+def fuse_results(vectorstore: FAISS, vector_docs: List[Document], exact_ids: List[str], lexical_ids: List[str],
+                 k: int = RETRIEVAL_K) -> List[Document]:
+    """Merge vector results with BM25 results by reciprocal rank fusion, exact code matches first"""
+    vector_ids = [doc.id for doc in vector_docs]
+    fused_ids = list(dict.fromkeys(exact_ids + reciprocal_rank_fusion([vector_ids, lexical_ids])))[:k]
+    if exact_ids:
+        print(f"Exact answer code match: {exact_ids}")
+    docs = [vectorstore.docstore.search(doc_id) for doc_id in fused_ids]
+    return [doc for doc in docs if isinstance(doc, Document)]
+
+def retrieve_documents_batch(states: List[AgentState], query_embeddings) -> List[AgentState]:
+    """Retrieve documents for many questions, with one FAISS matrix search per distinct filter
+
+    Like merge_retrieval, a group whose filtered search fails falls back to the unfiltered search,
+    and questions whose searches all failed get a retrieval_error instead of empty results.
+    """
+    vectorstore = states[0]["vectorstore"]
+    metadata_index = get_metadata_index(vectorstore)
+    filters = []
+    for state in states:
+        try:
+            filters.append(metadata_index.first_matching(search_filters(state.get("user_info"), state.get("query_filters"))))
+        except Exception as e:
+            print(f"Error resolving search filter: {e}")
+            filters.append(e)
+    groups: Dict[str, List[int]] = {}
+    for position, search_filter in enumerate(filters):
+        key = repr(search_filter) if isinstance(search_filter, Exception) else json.dumps(search_filter, sort_keys=True, ensure_ascii=False)
+        groups.setdefault(key, []).append(position)
     
+    results = list(states)
+    for positions in groups.values():
+        search_filter = filters[positions[0]]
+        matrix = np.array([query_embeddings[position] for position in positions], dtype="float32")
+        filter_error = None
+        try:
+            if isinstance(search_filter, Exception):
+                raise search_filter
+            hits = metadata_index.search_batch(vectorstore, matrix, RETRIEVAL_K, search_filter)
+        except Exception as e:
+            print(f"Error in filtered batch retrieval: {e}, falling back to regular search")
+            filter_error = str(e)
+            try:
+                hits = metadata_index.search_batch(vectorstore, matrix, RETRIEVAL_K)
+            except Exception as e:
+                print(f"Retrieval failed for {len(positions)} batch questions: {e}")
+                branches = {"filtered": {"error": filter_error}, "unfiltered": {"error": str(e)}}
+                for position in positions:
+                    results[position] = {**states[position], "retrieved_docs": [], "sources": [], "retrieval_branches": branches,
+                                         "retrieval_error": f"filtered: {filter_error}; unfiltered: {e}"}
+                continue
+        for position, position_hits in zip(positions, hits):
+            docs = [doc for doc, _ in position_hits]
+            if filter_error:
+                branches = {"filtered": {"error": filter_error}, "unfiltered": {"docs": docs}}
+            else:
+                branches = {"filtered": {"docs": docs, "filter": search_filter}}
+            # Lexical results are only fused into filtered ones, as in merge_retrieval
+            if HYBRID_SEARCH and not filter_error and all(doc.id for doc in docs):
+                query = states[position].get("search_query") or states[position]["question"]
+                try:
+                    exact_ids, lexical_ids = lexical_candidates(vectorstore, query, metadata_index.ids_for(search_filter))
+                    branches["lexical"] = {"exact_ids": exact_ids, "lexical_ids": lexical_ids}
+                    docs = fuse_results(vectorstore, docs, exact_ids, lexical_ids)
+                except Exception as e:
+                    print(f"Error in lexical batch retrieval: {e}")
+                    branches["lexical"] = {"error": str(e)}
+            sources = [doc.metadata.get("source", "Unknown") for doc in docs]
+            results[position] = {**states[position], "retrieved_docs": docs, "sources": list(set(sources)),
+                                 "retrieval_branches": branches, "retrieval_error": None}
+    return results
+
+def _search_query(state: AgentState) -> str:
+    # Search with the query process_user_query rewrote the question into
+    return state.get("search_query") or state["question"]
+
+def _query_embedding(state: AgentState) -> List[float]:
+    """Vector of the search query; branches running at the same time share one embedding call via the query cache"""
+    if state.get("query_embedding") is not None:
+        return state["query_embedding"]
+    return state["vectorstore"].embedding_function.embed_query(_search_query(state))
+
+def _search_filter(state: AgentState):
+    # Restrict candidates to "מוסד" answers purchasable with the user's budgets, relaxing
+    # the filter only when nothing matches; the relaxation is resolved without searching
+    filters = search_filters(state.get("user_info"), state.get("query_filters"))
+    return get_metadata_index(state["vectorstore"]).first_matching(filters), filters[0]
+
+def _filtered_search(state: AgentState) -> dict:
+    search_filter, preferred_filter = _search_filter(state)
+    if search_filter != preferred_filter:
+        print(f"No documents found for {preferred_filter}, falling back to filter {search_filter}")
+    docs = search_documents(state["vectorstore"], _query_embedding(state), k=RETRIEVAL_K, filter=search_filter)
+    return {"docs": docs, "filter": search_filter}
+
+def _unfiltered_search(state: AgentState) -> dict:
+    return {"docs": search_documents(state["vectorstore"], _query_embedding(state), k=RETRIEVAL_K)}
+
+def _lexical_search(state: AgentState) -> dict:
+    if not HYBRID_SEARCH:
+        return {}
+    vectorstore = state["vectorstore"]
+    allowed_ids = get_metadata_index(vectorstore).ids_for(_search_filter(state)[0])
+    exact_ids, lexical_ids = lexical_candidates(vectorstore, _search_query(state), allowed_ids)
+    return {"exact_ids": exact_ids, "lexical_ids": lexical_ids}
+
+def retrieval_branch(name: str, search):
+    """Wrap a search as a graph node that only writes its own entry of retrieval_branches
+
+    Branches run in parallel, so returning the whole state would make them write the same keys.
+    """
+    def branch(state: AgentState) -> dict:
+        if not state.get("vectorstore"):
+            return {"retrieval_branches": {name: {}}}
+        try:
+            result = search(state)
+        except Exception as e:
+            print(f"Error in {name} retrieval: {e}")
+            result = {"error": str(e)}
+        return {"retrieval_branches": {name: result}}
+    return branch
+
+# Independent searches the workflow runs concurrently before merge_retrieval
+RETRIEVAL_BRANCHES = {
+    "retrieve_filtered": retrieval_branch("filtered", _filtered_search),
+    "retrieve_unfiltered": retrieval_branch("unfiltered", _unfiltered_search),
+    "retrieve_lexical": retrieval_branch("lexical", _lexical_search)
+}
+
+def merge_retrieval(state: AgentState) -> AgentState:
+    """Combine the retrieval branches: filtered vector results fused with the lexical ones, unfiltered if filtering failed"""
+    vectorstore = state["vectorstore"]
     if not vectorstore:
         return {**state, "retrieved_docs": [], "sources": []}
+    branches = state.get("retrieval_branches") or {}
+    filtered, unfiltered, lexical = (branches.get(name) or {} for name in ("filtered", "unfiltered", "lexical"))
+    docs = filtered.get("docs")
+    if docs is None:
+        print("Metadata filtering failed, falling back to regular search")
+        docs = unfiltered.get("docs")
+    if docs is None:
+        # Both vector searches failed: nothing was searched, which is not the same as nothing matching
+        errors = [f"{name}: {branch['error']}" for name, branch in (("filtered", filtered), ("unfiltered", unfiltered))
+                  if branch.get("error")]
+        print(f"Retrieval failed: {errors}")
+        return {**state, "retrieved_docs": [], "sources": [], "retrieval_error": "; ".join(errors) or "retrieval failed"}
+    if filtered.get("docs") is not None and "exact_ids" in lexical and all(doc.id for doc in docs):
+        docs = fuse_results(vectorstore, docs, lexical["exact_ids"], lexical["lexical_ids"])
     
-    try:
-        # Create retriever with metadata filter for "מוסד" population
-        retriever = vectorstore.as_retriever(
-            search_kwargs={
-                "k": 6,
-                "filter": {"אוכלוסיה": "מוסד"}  # Filter for "מוסד" population only
-            }
-        )
-        
-        # Retrieve relevant documents (now filtered by metadata first)
-        docs = retriever.invoke(question)
-        
-        # If no documents found with "מוסד" filter, fallback to general search
-        if not docs:
-            print("No documents found with 'מוסד' filter, falling back to general search")
-            retriever_fallback = vectorstore.as_retriever(search_kwargs={"k": 6})
-            docs = retriever_fallback.invoke(question)
-        
-        # Extract sources
-        sources = [doc.metadata.get("source", "Unknown") for doc in docs]
-        
-        # Log filtering results for debugging
-        if docs:
-            populations = [doc.metadata.get("אוכלוסיה", "Unknown") for doc in docs]
-            print(f"Retrieved {len(docs)} documents with populations: {set(populations)}")
-        
-        return {
-            **state,
-            "retrieved_docs": docs,
-            "sources": list(set(sources))  # Remove duplicates
-        }
-        
-    except Exception as e:
-        print(f"Error retrieving documents: {e}")
-        # If metadata filtering fails, fallback to regular search
-        try:
-            print("Metadata filtering failed, falling back to regular search")
-            retriever = vectorstore.as_retriever(search_kwargs={"k": 6})
-            docs = retriever.invoke(question)
-            sources = [doc.metadata.get("source", "Unknown") for doc in docs]
-            
-            return {
-                **state,
-                "retrieved_docs": docs,
-                "sources": list(set(sources))
-            }
-        except Exception as fallback_error:
-            print(f"Fallback search also failed: {fallback_error}")
-            return {**state, "retrieved_docs": [], "sources": []}
+    # Extract sources
+    sources = [doc.metadata.get("source", "Unknown") for doc in docs]
+    
+    # Log filtering results for debugging
+    if docs:
+        populations = [doc.metadata.get("אוכלוסיה", "Unknown") for doc in docs]
+        print(f"Retrieved {len(docs)} documents with populations: {set(populations)}")
+    
+    return {
+        **state,
+        "retrieved_docs": docs,
+        "sources": list(set(sources)),  # Remove duplicates
+        "retrieval_error": None
+    }
 
-def generate_answer(state: AgentState) -> AgentState:
-    """Generate answer using retrieved documents"""
-    question = state["question"]
-    docs = state["retrieved_docs"]
-    user_info = state["user_info"]
+def retrieve_documents(state: AgentState) -> AgentState:
+    """Retrieve relevant documents from vectorstore with metadata filtering, running the branches one after another"""
+    if not state.get("vectorstore"):
+        return {**state, "retrieved_docs": [], "sources": []}
+    branches = {}
+    for name in ("retrieve_filtered", "retrieve_lexical"):
+        branches.update(RETRIEVAL_BRANCHES[name](state)["retrieval_branches"])
+    # The unfiltered search is only needed when the filtered one failed
+    if branches["filtered"].get("docs") is None:
+        branches.update(RETRIEVAL_BRANCHES["retrieve_unfiltered"](state)["retrieval_branches"])
+    return merge_retrieval({**state, "retrieval_branches": branches})
 
-    # Create context from retrieved documents
-    context = "\n\n".join([doc.page_content for doc in docs])
-    prompt = ChatPromptTemplate.from_messages([("system",
-        """אתה עוזר חכם המומחה למציאת מענים לפי שאלת המשתמש.
+ANSWER_INSTRUCTIONS = """אתה עוזר חכם המומחה למציאת מענים לפי שאלת המשתמש.
         **הנחיות:**
         - ענה בעברית בלבד
         - השתמש אך ורק במידע מהמסמכים המצורפים
@@ -113,34 +287,156 @@ def generate_answer(state: AgentState) -> AgentState:
             "answer": "התשובה כאן",
             "maanim": "קודי המענה מופרדים בפסיקים"
         }}
+        מספיקה התאמה של תקציב אחד שקיים למשתמש ומשויך למענה, אין צורך בהתאמה של כמה תקציבים.
+        """
+
+ANSWER_CONTEXT = """
         הקשר מהמסמכים:
         {context}
         מידע על תקציבי המשתמש:
         {user_info}
-        מספיקה התאמה של תקציב אחד שקיים למשתמש ומשויך למענה, אין צורך בהתאמה של כמה תקציבים.
-        """), ("human", "{question}")])
+        """
+
+if PROMPT_CACHING:
+    # The instructions are identical on every call, so Bedrock can reuse them from its cache;
+    # a prefix shorter than the model's minimum cacheable length is simply not cached
+    system_template = [{"type": "text", "text": ANSWER_INSTRUCTIONS}, {"cachePoint": {"type": "default"}},
+                       {"type": "text", "text": ANSWER_CONTEXT}]
+else:
+    system_template = ANSWER_INSTRUCTIONS + ANSWER_CONTEXT
+
+ANSWER_PROMPT = ChatPromptTemplate.from_messages([("system", system_template), ("human", "{question}")])
+
+# Changes whenever the prompt text changes, so cached answers from older prompts are not reused
+PROMPT_VERSION = hashlib.md5((repr(ANSWER_PROMPT.messages) + CONTEXT_VERSION).encode("utf-8")).hexdigest()[:12]
 
+GENERATION_ERROR_ANSWER = "מצטער, אירעה שגיאה ביצירת התשובה. אנא נסה שוב."
+# Same reply the prompt asks the model for when nothing in the context matches
+NO_MATCH_ANSWER = "לא מצאתי מענים מתאימים לשאלתך. אנא דייק את החיפוש."
+SINGLE_MATCH_ANSWER = "מצאתי מענה מתאים לשאלתך: {name}"
+# Answer from a template, without the LLM, when a question looks up an answer code that has one record or none
+SHORT_CIRCUIT_ANSWERS = os.getenv("SHORT_CIRCUIT_ANSWERS", "1") == "1"
+# A number named as an answer code: "קוד 627", "לקוד מענה 627", "מענה מספר 627"
+CODE_REFERENCE = re.compile(r"(?<![א-ת])[בלהוש]?(?:קוד|מענה)(?:\s+מענה)?(?:\s+(?:מספר|מס'?))?\s*[:#]?\s*(\d{2,})(?!\d)")
+# Other words a question naming a code may have and still be a lookup of that code
+CODE_LOOKUP_MAX_WORDS = int(os.getenv("CODE_LOOKUP_MAX_WORDS", 3))
+
+def build_answer_inputs(state: AgentState) -> dict:
+    """Build prompt variables from the question, retrieved documents and user budgets"""
+    # Create context from retrieved documents, deduped and trimmed to the token budget
+    context = build_context(state["retrieved_docs"])
+    record_context(context)
+    print(f"Context: {context['docs_used']} docs, ~{context['context_tokens']} tokens "
+          f"(saved ~{context['tokens_saved']}, dropped {context['docs_dropped']})")
+    return {
+        "context": context["context"],
+        "user_info": json.dumps(state["user_info"], ensure_ascii=False),
+        "question": state["question"]
+    }
+
+def generate_answer(state: AgentState) -> AgentState:
+    """Generate answer using retrieved documents"""
     try:
         # Generate response
-        chain = prompt | model | StrOutputParser()
-        answer = chain.invoke({
-            "context": context,
-            "user_info": json.dumps(user_info, ensure_ascii=False),
-            "question": question
-        })
+        chain = ANSWER_PROMPT | model | StrOutputParser()
+        answer = chain.invoke(build_answer_inputs(state))
         
         return {**state, "answer": answer}
         
     except Exception as e:
         print(f"Error generating answer: {e}")
-        return {
-            **state, 
-            "answer": "מצטער, אירעה שגיאה ביצירת התשובה. אנא נסה שוב."
-        }
+        return {**state, "answer": GENERATION_ERROR_ANSWER}
 
-def process_user_query(state: AgentState) -> AgentState:
-    """Process user query and generate a search query"""
+def record_field(doc: Document, field: str) -> Optional[str]:
+    """Read a field of a catalog record from its compact "field: value | ..." rendering"""
+    for part in render_compact(doc).split(" | "):
+        key, separator, value = part.partition(": ")
+        if separator and key.strip() == field and value.strip():
+            return value.strip()
+    return None
+
+def lookup_code(question: str) -> Optional[str]:
+    """The answer code a question only looks up: a code alone, or one named as a code with few other words"""
+    codes = set(CODE_PATTERN.findall(question))
+    if len(codes) != 1:
+        return None
+    named = CODE_REFERENCE.search(question)
+    other_words = re.findall(r"[א-תA-Za-z]+", (CODE_REFERENCE if named else CODE_PATTERN).sub(" ", question))
+    if len(other_words) > (CODE_LOOKUP_MAX_WORDS if named else 0):
+        return None
+    return codes.pop()
+
+def single_code_match(state: AgentState) -> Optional[Tuple[str, str]]:
+    """Name and code of the answer when the question looks up a code that matched exactly one retrieved record"""
+    code = lookup_code(state["question"])
+    if code is None:
+        return None
+    exact_ids = ((state.get("retrieval_branches") or {}).get("lexical") or {}).get("exact_ids") or []
+    matches = [doc for doc in state.get("retrieved_docs") or []
+               if doc.id in exact_ids and str(doc.metadata.get("קוד_מענה")) == code]
+    if len({doc.metadata.get("record_key") for doc in matches}) != 1:
+        return None
+    name = record_field(matches[0], "שם_מענה")
+    return (name, code) if name else None
+
+def unknown_code(state: AgentState) -> bool:
+    """Check if the question looks up a code no record in the catalog has"""
+    code = lookup_code(state["question"])
+    return code is not None and bool(state.get("vectorstore")) and code not in get_lexical_index(state["vectorstore"]).codes
+
+def route_answer(state: AgentState) -> str:
+    """Choose the answer path: retrieval_failed when the searches failed, no_match for a code lookup of an
+    unknown code, single_match for a code lookup with one matching record, else generate"""
+    route = "generate"
+    if state.get("retrieval_error"):
+        route = "retrieval_failed"
+    elif SHORT_CIRCUIT_ANSWERS:
+        if unknown_code(state):
+            route = "no_match"
+        elif single_code_match(state):
+            route = "single_match"
+    record_route(route)
+    return route
+
+def no_match_answer(state: AgentState) -> AgentState:
+    """Answer that nothing matched, in the model's JSON format"""
+    answer = json.dumps({"answer": NO_MATCH_ANSWER, "maanim": ""}, ensure_ascii=False)
+    return {**state, "answer": answer}
+
+def single_match_answer(state: AgentState) -> AgentState:
+    """Answer with the one record the looked-up code matched, in the model's JSON format"""
+    name, code = single_code_match(state)
+    answer = json.dumps({"answer": SINGLE_MATCH_ANSWER.format(name=name), "maanim": code}, ensure_ascii=False)
+    return {**state, "answer": answer}
+
+def retrieval_error_answer(state: AgentState) -> AgentState:
+    """Answer with the error reply, which callers never put in the answer cache"""
+    return {**state, "answer": GENERATION_ERROR_ANSWER}
+
+# Routes answered without the LLM, by the name route_answer returns
+TEMPLATED_ANSWERS = {"no_match": no_match_answer, "single_match": single_match_answer,
+                     "retrieval_failed": retrieval_error_answer}
+
+def apply_plan(state: AgentState, plan: dict) -> AgentState:
+    """Put a query plan's search query and filters into the state"""
     question = state["question"]
-    # TODO: call llm to generate search query
-    return {**state, "search_query": question} 
+    search_query = plan["search_query"]
+    if search_query != question or plan["filters"]:
+        print(f"Search query: {search_query}, filters: {plan['filters']}")
+    return {
+        **state,
+        "search_query": search_query,
+        "query_filters": plan["filters"],
+        # An embedding of the question is only reusable when the question is what gets searched
+        "query_embedding": state.get("query_embedding") if search_query == question else None
+    }
+
+def process_user_query(state: AgentState) -> AgentState:
+    """Rewrite the question into a focused search query and filters for retrieval"""
+    plan = query_planner.plan(state["question"], user_budget_names(state.get("user_info")))
+    return apply_plan(state, plan)
 
+def process_user_queries(states: List[AgentState]) -> List[AgentState]:
+    """Rewrite many questions concurrently, all waiting on one shared deadline"""
+    plans = query_planner.plan_many([(state["question"], user_budget_names(state.get("user_info"))) for state in states])
+    return [apply_plan(state, plan) for state, plan in zip(states, plans)]
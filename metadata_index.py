@@ -0,0 +1,119 @@
+import threading
+import weakref
+from typing import Dict, List, Optional, Tuple
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+from langchain_community.vectorstores import FAISS
+
+# Metadata fields that filtered searches can restrict on
+INDEXED_FIELDS = ("אוכלוסיה", "קוד_מענה", "קוד_תקציב", "שם_תקציב")
+
+
+def search_parameters(index, selector):
+    """Build search parameters of the type the index expects, restricted to the selector"""
+    base_index = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexPreTransform) else faiss.downcast_index(index)
+    # Parameter objects carry their own efSearch/nprobe defaults, so copy the index's tuning
+    if isinstance(base_index, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=base_index.hnsw.efSearch)
+    if isinstance(base_index, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=base_index.nprobe)
+    return faiss.SearchParameters(sel=selector)
+
+
+class MetadataIndex:
+    """Inverted index from metadata values to FAISS row ids for prefiltered search"""
+
+    def __init__(self, vectorstore: FAISS):
+        postings: Dict[Tuple[str, str], List[int]] = {}
+        for position, doc_id in vectorstore.index_to_docstore_id.items():
+            doc = vectorstore.docstore._dict.get(doc_id)
+            if doc is None:
+                continue
+            for field in INDEXED_FIELDS:
+                values = doc.metadata.get(field)
+                if values is None:
+                    continue
+                for value in values if isinstance(values, (list, tuple, set)) else [values]:
+                    postings.setdefault((field, str(value)), []).append(position)
+        self.postings = {key: np.array(sorted(set(ids)), dtype="int64") for key, ids in postings.items()}
+        self.ntotal = vectorstore.index.ntotal
+
+    def values(self, field: str) -> List[str]:
+        """List indexed values of a field"""
+        return [value for indexed_field, value in self.postings if indexed_field == field]
+
+    def ids_for(self, filter: dict) -> Optional[np.ndarray]:
+        """Resolve a filter to matching row ids; list values match any, fields must all match"""
+        if not filter:
+            return None
+        ids = None
+        for field, wanted in filter.items():
+            wanted_values = wanted if isinstance(wanted, (list, tuple, set)) else [wanted]
+            field_ids = [self.postings.get((field, str(value))) for value in wanted_values]
+            field_ids = [array for array in field_ids if array is not None]
+            matched = np.unique(np.concatenate(field_ids)) if field_ids else np.array([], dtype="int64")
+            ids = matched if ids is None else np.intersect1d(ids, matched, assume_unique=True)
+            if len(ids) == 0:
+                break
+        return ids
+
+    def first_matching(self, filters: List[Optional[dict]]) -> Optional[dict]:
+        """Pick the first filter, in priority order, that matches at least one row"""
+        for candidate in filters:
+            ids = self.ids_for(candidate)
+            if ids is None or len(ids) > 0:
+                return candidate
+        return None
+
+    def search(self, vectorstore: FAISS, query_embedding: List[float], k: int,
+               filter: Optional[dict] = None) -> List[Tuple[Document, float]]:
+        """Search only over rows matching the filter, with a single FAISS call"""
+        return self.search_batch(vectorstore, [query_embedding], k, filter)[0]
+
+    def search_batch(self, vectorstore: FAISS, query_embeddings, k: int,
+                     filter: Optional[dict] = None) -> List[List[Tuple[Document, float]]]:
+        """Search many queries sharing one filter as a single FAISS matrix search"""
+        ids = self.ids_for(filter)
+        queries = np.array(query_embeddings, dtype="float32")
+        if vectorstore._normalize_L2:
+            faiss.normalize_L2(queries)
+        if ids is None:
+            scores, positions = vectorstore.index.search(queries, k)
+        elif len(ids) == 0:
+            return [[] for _ in range(len(queries))]
+        else:
+            selector = faiss.IDSelectorBatch(ids)
+            params = search_parameters(vectorstore.index, selector)
+            scores, positions = vectorstore.index.search(queries, min(k, len(ids)), params=params)
+        batch_results = []
+        for row_scores, row_positions in zip(scores, positions):
+            results = []
+            for score, position in zip(row_scores, row_positions):
+                if position == -1:
+                    continue
+                doc = vectorstore.docstore.search(vectorstore.index_to_docstore_id[int(position)])
+                if isinstance(doc, Document):
+                    results.append((doc, float(score)))
+            batch_results.append(results)
+        return batch_results
+
+
+_indexes = weakref.WeakKeyDictionary()
+_indexes_lock = threading.Lock()
+
+
+def get_metadata_index(vectorstore: FAISS) -> MetadataIndex:
+    """Get the metadata index for a vectorstore, building it on first use"""
+    with _indexes_lock:
+        metadata_index = _indexes.get(vectorstore)
+        if metadata_index is None or metadata_index.ntotal != vectorstore.index.ntotal:
+            metadata_index = MetadataIndex(vectorstore)
+            _indexes[vectorstore] = metadata_index
+        return metadata_index
+
+
+def invalidate_metadata_index(vectorstore: FAISS):
+    """Drop the cached metadata index after the vectorstore changes"""
+    with _indexes_lock:
+        _indexes.pop(vectorstore, None)
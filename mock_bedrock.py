@@ -0,0 +1,199 @@
+"""Local stand-in for the Bedrock runtime API.
+
+Serves InvokeModel (Titan/Cohere embeddings, Anthropic messages), Converse and
+their streaming variants with deterministic responses, and simulates prompt
+caching for system prompts that contain a cache point. Point the app at it with:
+
+    python mock_bedrock.py --port 8765
+    BEDROCK_ENDPOINT_URL=http://localhost:8765 AWS_ACCESS_KEY_ID=mock AWS_SECRET_ACCESS_KEY=mock python api.py
+"""
+import os
+import re
+import json
+import time
+import zlib
+import base64
+import struct
+import hashlib
+import argparse
+import threading
+from flask import Flask, Response, jsonify, request
+from embedding_pipeline import StubEmbeddings
+
+MOCK_LATENCY = float(os.getenv("MOCK_BEDROCK_LATENCY", 0))
+EMBEDDING_DIMENSION = int(os.getenv("MOCK_EMBEDDING_DIMENSION", 1536))
+NO_MATCH_ANSWER = "לא מצאתי מענים מתאימים לשאלתך. אנא דייק את החיפוש."
+
+app = Flask(__name__)
+stub_embeddings = StubEmbeddings(dimension=EMBEDDING_DIMENSION)
+# Hashes of cached prompt prefixes, like Bedrock's cache for the lifetime of the server
+_prompt_cache = set()
+_prompt_cache_lock = threading.Lock()
+stats = {"invoke": 0, "converse": 0, "cache_reads": 0, "cache_writes": 0}
+
+
+def count_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def mock_answer(prompt: str) -> str:
+    """Answer with the answer codes found in the prompt context, in the app's JSON format"""
+    codes = list(dict.fromkeys(re.findall(r"קוד_מענה\"?:\s*(\d+)", prompt)))[:5]
+    if not codes:
+        return json.dumps({"answer": NO_MATCH_ANSWER, "maanim": ""}, ensure_ascii=False)
+    return json.dumps({"answer": "מצאתי מענים מתאימים לשאלתך", "maanim": ", ".join(codes)}, ensure_ascii=False)
+
+
+def text_of(content) -> str:
+    """Flatten Anthropic or Converse message content to text"""
+    if isinstance(content, str):
+        return content
+    return "".join(block.get("text", "") for block in content if isinstance(block, dict))
+
+
+def prompt_cache_usage(system_blocks: list) -> dict:
+    """Simulate Bedrock prompt caching: blocks before a cache point are written once, then read"""
+    positions = [i for i, block in enumerate(system_blocks) if "cachePoint" in block or "cache_control" in block]
+    if not positions:
+        return {"cacheReadInputTokens": 0, "cacheWriteInputTokens": 0}
+    prefix = system_blocks[:positions[-1] + 1]
+    prefix_tokens = count_tokens(text_of(prefix))
+    key = hashlib.sha256(json.dumps(prefix, sort_keys=True).encode("utf-8")).hexdigest()
+    with _prompt_cache_lock:
+        hit = key in _prompt_cache
+        _prompt_cache.add(key)
+        stats["cache_reads" if hit else "cache_writes"] += 1
+    if hit:
+        return {"cacheReadInputTokens": prefix_tokens, "cacheWriteInputTokens": 0}
+    return {"cacheReadInputTokens": 0, "cacheWriteInputTokens": prefix_tokens}
+
+
+def event_message(event_type: str, payload: dict) -> bytes:
+    """Encode one message of the AWS event stream format used by the streaming APIs"""
+    headers = b""
+    for name, value in ((":event-type", event_type), (":content-type", "application/json"), (":message-type", "event")):
+        name_bytes, value_bytes = name.encode("utf-8"), value.encode("utf-8")
+        headers += struct.pack(">B", len(name_bytes)) + name_bytes + b"\x07" + struct.pack(">H", len(value_bytes)) + value_bytes
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    prelude = struct.pack(">II", 16 + len(headers) + len(body), len(headers))
+    message = prelude + struct.pack(">I", zlib.crc32(prelude)) + headers + body
+    return message + struct.pack(">I", zlib.crc32(message))
+
+
+def text_pieces(text: str, size: int = 8):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def converse_request() -> tuple:
+    """Answer a Converse request and compute its token usage"""
+    body = request.get_json(force=True)
+    system = body.get("system", [])
+    prompt = text_of(system) + "".join(text_of(message.get("content", [])) for message in body.get("messages", []))
+    answer = mock_answer(prompt)
+    cache = prompt_cache_usage(system)
+    input_tokens = count_tokens(prompt) - cache["cacheReadInputTokens"]
+    usage = {"inputTokens": input_tokens, "outputTokens": count_tokens(answer),
+             "totalTokens": input_tokens + count_tokens(answer), **cache}
+    return answer, usage
+
+
+@app.route("/model/<path:model_id>/invoke", methods=["POST"])
+def invoke_model(model_id):
+    time.sleep(MOCK_LATENCY)
+    stats["invoke"] += 1
+    body = request.get_json(force=True)
+    if "inputText" in body:
+        return jsonify({"embedding": stub_embeddings.embed_query(body["inputText"]),
+                        "inputTextTokenCount": count_tokens(body["inputText"])})
+    if "texts" in body:
+        return jsonify({"embeddings": stub_embeddings.embed_documents(body["texts"]), "texts": body["texts"]})
+    prompt = text_of(body.get("system", "")) + "".join(text_of(message["content"]) for message in body.get("messages", []))
+    answer = mock_answer(prompt)
+    response = jsonify({
+        "id": f"msg_{hashlib.md5(prompt.encode('utf-8')).hexdigest()[:12]}",
+        "type": "message",
+        "role": "assistant",
+        "model": model_id,
+        "content": [{"type": "text", "text": answer}],
+        "stop_reason": "end_turn",
+        "usage": {"input_tokens": count_tokens(prompt), "output_tokens": count_tokens(answer)}
+    })
+    # InvokeModel reports token counts in response headers
+    response.headers["X-Amzn-Bedrock-Input-Token-Count"] = str(count_tokens(prompt))
+    response.headers["X-Amzn-Bedrock-Output-Token-Count"] = str(count_tokens(answer))
+    return response
+
+
+@app.route("/model/<path:model_id>/invoke-with-response-stream", methods=["POST"])
+def invoke_model_stream(model_id):
+    stats["invoke"] += 1
+    body = request.get_json(force=True)
+    prompt = text_of(body.get("system", "")) + "".join(text_of(message["content"]) for message in body.get("messages", []))
+    answer = mock_answer(prompt)
+
+    def chunk(payload: dict) -> bytes:
+        data = base64.b64encode(json.dumps(payload, ensure_ascii=False).encode("utf-8")).decode("ascii")
+        return event_message("chunk", {"bytes": data})
+
+    def events():
+        time.sleep(MOCK_LATENCY)
+        yield chunk({"type": "message_start", "message": {
+            "id": "msg_mock", "type": "message", "role": "assistant", "model": model_id, "content": [],
+            "usage": {"input_tokens": count_tokens(prompt), "output_tokens": 0}}})
+        yield chunk({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}})
+        for piece in text_pieces(answer):
+            yield chunk({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": piece}})
+        yield chunk({"type": "content_block_stop", "index": 0})
+        yield chunk({"type": "message_delta", "delta": {"stop_reason": "end_turn"},
+                     "usage": {"output_tokens": count_tokens(answer)}})
+        yield chunk({"type": "message_stop", "amazon-bedrock-invocationMetrics": {
+            "inputTokenCount": count_tokens(prompt), "outputTokenCount": count_tokens(answer)}})
+
+    return Response(events(), mimetype="application/vnd.amazon.eventstream")
+
+
+@app.route("/model/<path:model_id>/converse", methods=["POST"])
+def converse(model_id):
+    time.sleep(MOCK_LATENCY)
+    stats["converse"] += 1
+    answer, usage = converse_request()
+    return jsonify({
+        "output": {"message": {"role": "assistant", "content": [{"text": answer}]}},
+        "stopReason": "end_turn",
+        "usage": usage,
+        "metrics": {"latencyMs": int(MOCK_LATENCY * 1000)}
+    })
+
+
+@app.route("/model/<path:model_id>/converse-stream", methods=["POST"])
+def converse_stream(model_id):
+    stats["converse"] += 1
+    answer, usage = converse_request()
+
+    def events():
+        time.sleep(MOCK_LATENCY)
+        yield event_message("messageStart", {"role": "assistant"})
+        for piece in text_pieces(answer):
+            yield event_message("contentBlockDelta", {"contentBlockIndex": 0, "delta": {"text": piece}})
+        yield event_message("contentBlockStop", {"contentBlockIndex": 0})
+        yield event_message("messageStop", {"stopReason": "end_turn"})
+        yield event_message("metadata", {"usage": usage, "metrics": {"latencyMs": int(MOCK_LATENCY * 1000)}})
+
+    return Response(events(), mimetype="application/vnd.amazon.eventstream")
+
+
+@app.route("/stats", methods=["GET"])
+def get_stats():
+    return jsonify(stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local mock of the Bedrock runtime API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+import os
+import re
+import json
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from typing import Dict, List, Optional, Tuple
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.output_parsers import StrOutputParser
+from langchain_aws import ChatBedrock
+from bedrock_client import get_bedrock_runtime, BEDROCK_REGION
+from answer_cache import normalize_question
+from lexical_index import CODE_PATTERN
+from tracing import query_rewrites, tracing_config
+
+# Small, fast model that rewrites questions into search queries; empty disables rewriting
+QUERY_REWRITE_MODEL_ID = os.getenv("QUERY_REWRITE_MODEL_ID", "anthropic.claude-3-haiku-20240307-v1:0")
+# Past this many seconds the raw question is searched instead of waiting for the rewrite
+QUERY_REWRITE_TIMEOUT = float(os.getenv("QUERY_REWRITE_TIMEOUT", 1.5))
+QUERY_REWRITE_CACHE_SIZE = int(os.getenv("QUERY_REWRITE_CACHE_SIZE", 2048))
+QUERY_REWRITE_WORKERS = int(os.getenv("QUERY_REWRITE_WORKERS", 8))
+# Rewrites queued or running at once; past this the question is searched as is rather than queued behind a backlog
+QUERY_REWRITE_MAX_PENDING = int(os.getenv("QUERY_REWRITE_MAX_PENDING", QUERY_REWRITE_WORKERS * 2))
+# Values of the "אוכלוסיה" metadata field
+POPULATIONS = ("מוסד", "רשות", "מחז")
+
+try:
+    rewrite_model = ChatBedrock(
+        model_id=QUERY_REWRITE_MODEL_ID,
+        model_kwargs={"temperature": 0, "max_tokens": 200},
+        region_name=BEDROCK_REGION,
+        client=get_bedrock_runtime()
+    ) if QUERY_REWRITE_MODEL_ID else None
+except Exception as e:
+    print(f"Error initializing query rewrite model: {e}")
+    rewrite_model = None
+
+REWRITE_INSTRUCTIONS = """אתה מנסח שאילתות חיפוש למאגר מענים חינוכיים.
+        המר את שאלת המשתמש לשאילתת חיפוש קצרה וממוקדת: מילות מפתח בעברית תקנית, בלי מילות פתיחה או נימוס.
+        שמור כל מספר שמופיע בשאלה (קוד מענה או קוד תקציב) בדיוק כפי שהוא.
+        חלץ מסננים רק אם הם מוזכרים במפורש בשאלה:
+        - population: אחד מהערכים {populations}, או null
+        - budgets: שמות סלי התקציב מתוך הרשימה {budgets} שהשאלה מזכירה, או רשימה ריקה
+
+        **פורמט תגובה (JSON בלבד):**
+        {{"search_query": "שאילתת החיפוש", "population": null, "budgets": []}}
+        """
+
+REWRITE_PROMPT = ChatPromptTemplate.from_messages([("system", REWRITE_INSTRUCTIONS), ("human", "{question}")])
+
+
+def parse_plan(text: str, question: str, budget_names: List[str]) -> dict:
+    """Parse the model's JSON into a search query and metadata filters, dropping values outside the known ones"""
+    match = re.search(r"\{.*\}", text, re.DOTALL)
+    plan = json.loads(match.group(0) if match else text)
+    search_query = " ".join(str(plan.get("search_query") or "").split()) or question
+    # Codes drive the exact-match lookup, so never let the rewrite lose one
+    missing_codes = [code for code in CODE_PATTERN.findall(question) if code not in CODE_PATTERN.findall(search_query)]
+    if missing_codes:
+        search_query = " ".join([search_query] + missing_codes)
+    filters = {}
+    if plan.get("population") in POPULATIONS:
+        filters["אוכלוסיה"] = plan["population"]
+    budgets = [name for name in plan.get("budgets") or [] if name in budget_names]
+    if budgets:
+        filters["שם_תקציב"] = budgets
+    return {"search_query": search_query, "filters": filters}
+
+
+class QueryPlanner:
+    """Rewrites questions into search queries and filters with a fast model, a cache and a deadline"""
+
+    def __init__(self, model, timeout: float = QUERY_REWRITE_TIMEOUT, cache_size: int = QUERY_REWRITE_CACHE_SIZE):
+        self.model = model
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=QUERY_REWRITE_WORKERS, thread_name_prefix="rewrite")
+        self._pending = threading.BoundedSemaphore(QUERY_REWRITE_MAX_PENDING)
+
+    def plan(self, question: str, budget_names: List[str]) -> dict:
+        """Get the search query and filters for a question; the raw question and no filters if the model is slow or fails"""
+        return self.plan_many([(question, budget_names)])[0]
+
+    def plan_many(self, questions: List[Tuple[str, List[str]]]) -> List[dict]:
+        """Plan (question, budget names) pairs together: their rewrites run concurrently against one shared deadline"""
+        plans = [{"search_query": question, "filters": {}} for question, _ in questions]
+        if self.model is None:
+            return plans
+        futures: Dict[tuple, Future] = {}
+        pending = []
+        saturated = 0
+        for position, (question, budget_names) in enumerate(questions):
+            key = (normalize_question(question), tuple(budget_names))
+            cached = self._get(key)
+            if cached is not None:
+                query_rewrites.inc(outcome="cached")
+                plans[position] = cached
+                continue
+            if key not in futures:
+                if not self._pending.acquire(blocking=False):
+                    saturated += 1
+                    query_rewrites.inc(outcome="saturated")
+                    continue
+                futures[key] = self._executor.submit(self._rewrite, question, budget_names)
+                # A rewrite that misses the deadline but still runs is cached for the next time the question is asked
+                futures[key].add_done_callback(lambda done, key=key: self._finish(key, done))
+            pending.append((position, futures[key]))
+
+        deadline = time.monotonic() + self.timeout
+        timed_out = 0
+        for position, future in pending:
+            try:
+                plans[position] = future.result(timeout=max(0.0, deadline - time.monotonic()))
+            except TimeoutError:
+                # Rewrites still queued are dropped rather than left to call the model for nobody
+                future.cancel()
+                timed_out += 1
+                query_rewrites.inc(outcome="timeout")
+            except Exception as e:
+                print(f"Error rewriting query: {e}")
+                query_rewrites.inc(outcome="error")
+            else:
+                query_rewrites.inc(outcome="rewritten")
+        if timed_out:
+            print(f"{timed_out} query rewrites timed out after {self.timeout}s, searching those questions as is")
+        if saturated:
+            print(f"Query rewriter saturated, searching {saturated} questions as is")
+        return plans
+
+    def _rewrite(self, question: str, budget_names: List[str]) -> dict:
+        chain = REWRITE_PROMPT | self.model | StrOutputParser()
+        text = chain.invoke({
+            "question": question,
+            "populations": ", ".join(POPULATIONS),
+            "budgets": json.dumps(budget_names, ensure_ascii=False)
+        }, config=tracing_config("rewrite"))
+        return parse_plan(text, question, budget_names)
+
+    def _get(self, key) -> Optional[dict]:
+        with self._lock:
+            plan = self._cache.get(key)
+            if plan is not None:
+                self._cache.move_to_end(key)
+            return plan
+
+    def _finish(self, key, future):
+        self._pending.release()
+        if future.cancelled() or future.exception() is not None:
+            return
+        with self._lock:
+            self._cache[key] = future.result()
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"model": QUERY_REWRITE_MODEL_ID if self.model else None, "entries": len(self._cache),
+                    "max_entries": self.cache_size, "timeout_seconds": self.timeout,
+                    "max_pending": QUERY_REWRITE_MAX_PENDING}
+
+
+query_planner = QueryPlanner(rewrite_model)
@@ -1,129 +1,644 @@
 import os
+import re
+import csv
 import json
+import shutil
 import hashlib
-from typing import List
+import weakref
+import numpy as np
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional
+import openpyxl
 from langchain_aws import BedrockEmbeddings
 from langchain_core.documents import Document
+import faiss
 from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores.utils import DistanceStrategy
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from dotenv import load_dotenv
 from pathlib import Path
+from bedrock_client import get_bedrock_runtime, BEDROCK_REGION
+from embedding_cache import EmbeddingCache, CachedEmbeddings
+from embedding_pipeline import StubEmbeddings, add_documents_concurrently, embed_in_batches
+from metadata_index import invalidate_metadata_index
+from lexical_index import invalidate_lexical_index
 
 load_dotenv()
 
 VECTORSTORE_DIR = "vectorDB"
+EMBEDDING_MODEL_ID = os.getenv("EMBEDDING_MODEL_ID", "amazon.titan-embed-text-v1")
+# "stub" swaps Bedrock for deterministic offline embeddings (local testing only)
+EMBEDDINGS_BACKEND = os.getenv("EMBEDDINGS_BACKEND", "bedrock")
+# flat (exact), hnsw, ivfpq, sq8, or any other faiss.index_factory description
+VECTOR_INDEX_TYPE = os.getenv("VECTOR_INDEX_TYPE", "flat")
+HNSW_M = int(os.getenv("HNSW_M", 32))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", 80))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", 64))
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", 16))
+PQ_M = int(os.getenv("PQ_M", 48))
+PQ_NBITS = int(os.getenv("PQ_NBITS", 8))
+# Each PQ codebook has 2**PQ_NBITS centroids and faiss wants 39 training vectors per centroid;
+# below this an IVF-PQ index is badly trained, so a flat index is built instead
+IVF_MIN_VECTORS = 39 * 2 ** PQ_NBITS
+# Vectors sampled to train IVF centroids and PQ codebooks, never fewer than IVF_MIN_VECTORS
+INDEX_TRAIN_SAMPLE = max(int(os.getenv("INDEX_TRAIN_SAMPLE", 50000)), IVF_MIN_VECTORS)
 
 os.makedirs(VECTORSTORE_DIR, exist_ok=True)
 
 try:
-    embeddings = BedrockEmbeddings(
-        model_id="amazon.titan-embed-text-v1",
-        # cohere.embed-multilingual-v3
-        region_name=os.getenv("AWS_REGION", "us-east-1")
-    )
-    print("AWS Bedrock models initialized successfully")
+    if EMBEDDINGS_BACKEND == "stub":
+        EMBEDDING_MODEL_ID = "stub"
+        embeddings = StubEmbeddings()
+        print("Using stub embeddings")
+    else:
+        embeddings = BedrockEmbeddings(
+            model_id=EMBEDDING_MODEL_ID,
+            # cohere.embed-multilingual-v3
+            region_name=BEDROCK_REGION,
+            client=get_bedrock_runtime()
+        )
+        print("AWS Bedrock models initialized successfully")
 except Exception as e:
     print(f"Error initializing AWS Bedrock: {e}")
     # model = None
     embeddings = None
 
+# Chunk embeddings are cached on disk so rebuilds only embed new chunks
+embedding_cache = EmbeddingCache()
+cached_embeddings = CachedEmbeddings(embeddings, embedding_cache, EMBEDDING_MODEL_ID) if embeddings else None
+
+HASH_CHUNK_SIZE = 1024 * 1024
+JSON_READ_SIZE = 64 * 1024
+# Records parsed and embedded together when streaming a data file
+LOAD_BATCH_SIZE = int(os.getenv("LOAD_BATCH_SIZE", 500))
+JSON_SEPARATOR = re.compile(r"\s*,?\s*")
+# Multi-valued CSV/XLSX cells, e.g. several budgets in one cell
+LIST_SEPARATOR = re.compile(r"[\n;|]")
+
+# file path -> (stat signature, md5) so unchanged files are never re-read
+_file_hashes: Dict[str, tuple] = {}
+
+def file_signature(file_path: str):
+    """Cheap change signature from stat metadata: mtime, size and inode"""
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
 def get_file_hash(file_path: str) -> str:
     """Generate hash for file to track changes"""
+    signature = file_signature(file_path)
+    cached = _file_hashes.get(file_path)
+    if signature and cached and cached[0] == signature:
+        return cached[1]
+    
     hash_md5 = hashlib.md5()
     try:
         with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
                 hash_md5.update(chunk)
-        return hash_md5.hexdigest()
+        file_hash = hash_md5.hexdigest()
+        if signature:
+            _file_hashes[file_path] = (signature, file_hash)
+        return file_hash
     except Exception as e:
         print(f"Error generating file hash: {e}")
         return ""
 
-def load_document(file_path: str) -> List[Document]:
-    """Load and process document based on file type"""
-    documents = []
+def parse_budgets(budgets) -> Dict[str, List[str]]:
+    """Split budget entries like "12 סל תשתיות בית ספריות" into deduplicated codes and names"""
+    entries = list(dict.fromkeys(str(budget).strip() for budget in budgets or [] if str(budget).strip()))
+    codes, names = [], []
+    for entry in entries:
+        match = re.match(r"^(\d+)\s+(.*)$", entry)
+        code, name = (match.group(1), match.group(2).strip()) if match else (None, entry)
+        if code and code not in codes:
+            codes.append(code)
+        if name not in names:
+            names.append(name)
+    return {"תקציבים": entries, "קוד_תקציב": codes, "שם_תקציב": names}
+
+def iter_batches(items: Iterable, batch_size: int) -> Iterator[list]:
+    """Group an iterable into lists of at most batch_size items"""
+    iterator = iter(items)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
+
+def iter_json_items(file_path: str) -> Iterator:
+    """Yield the items of a top-level JSON array without loading the whole file"""
+    decoder = json.JSONDecoder()
+    with open(file_path, 'r', encoding='utf-8-sig') as f:
+        buffer = f.read(JSON_READ_SIZE).lstrip()
+        if not buffer.startswith('['):
+            # Not an array, so there is nothing to stream
+            data = json.loads(buffer + f.read())
+            yield from (data if isinstance(data, list) else [data])
+            return
+        position, eof = 1, False
+        while True:
+            position = JSON_SEPARATOR.match(buffer, position).end()
+            if buffer.startswith(']', position):
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+                # A number at the end of the buffer may continue in the next read
+                complete = end < len(buffer) or eof
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                complete = False
+            if not complete:
+                chunk = f.read(JSON_READ_SIZE)
+                eof = not chunk
+                buffer, position = buffer[position:] + chunk, 0
+                continue
+            yield item
+            position = end
+
+def iter_csv_rows(file_path: str) -> Iterator[dict]:
+    """Yield CSV rows one at a time as header -> value dicts"""
+    with open(file_path, 'r', encoding='utf-8-sig', newline='') as f:
+        yield from csv.DictReader(f)
+
+def iter_xlsx_rows(file_path: str) -> Iterator[dict]:
+    """Yield rows of every sheet as header -> value dicts, streaming the workbook in read-only mode"""
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        for sheet in workbook.worksheets:
+            rows = sheet.iter_rows(values_only=True)
+            header = next(rows, None)
+            if not header:
+                continue
+            columns = [str(column).strip() if column is not None else None for column in header]
+            for values in rows:
+                yield dict(zip(columns, values))
+    finally:
+        workbook.close()
+
+def normalize_row(row: dict) -> dict:
+    """Convert a flat CSV/XLSX row into the shape of a JSON catalog item"""
+    item = {}
+    for key, value in row.items():
+        # DictReader puts cells beyond the header under None
+        if key is None:
+            continue
+        if isinstance(value, str):
+            value = value.strip()
+        if value is None or value == "":
+            continue
+        item[str(key).strip()] = value
+    code = item.get("קוד_מענה")
+    if isinstance(code, float) and code.is_integer():
+        item["קוד_מענה"] = int(code)
+    elif isinstance(code, str) and code.isdigit():
+        item["קוד_מענה"] = int(code)
+    if isinstance(item.get("תקציבים"), str):
+        item["תקציבים"] = [budget.strip() for budget in LIST_SEPARATOR.split(item["תקציבים"]) if budget.strip()]
+    return item
+
+def with_content_hash(document: Document) -> Document:
+    """Hash content plus filterable metadata so incremental updates catch both"""
+    hashed_metadata = {k: v for k, v in document.metadata.items() if k != "index"}
+    hashed = document.page_content + json.dumps(hashed_metadata, sort_keys=True, ensure_ascii=False)
+    document.metadata["content_hash"] = hashlib.md5(hashed.encode("utf-8")).hexdigest()
+    return document
+
+def render_record(item) -> str:
+    """Render a catalog record as compact "field: value" lines, deduplicating repeated list entries"""
+    if not isinstance(item, dict):
+        return json.dumps(item, ensure_ascii=False)
+    lines = []
+    for key, value in item.items():
+        if isinstance(value, list):
+            entries = dict.fromkeys(str(entry).strip() for entry in value if entry is not None and str(entry).strip())
+            value = "; ".join(entries)
+        elif isinstance(value, dict):
+            value = json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+        elif value is not None:
+            value = str(value).strip()
+        if value:
+            lines.append(f"{key}: {value}")
+    return "\n".join(lines)
+
+def record_document(item, i: int, source: str, doc_type: str, occurrence: int = 1) -> Document:
+    """Build the document for one catalog record; occurrence numbers the records that share its code"""
+    #TODO: get the population from the json file
+    if i < 10:
+        population = "מוסד"
+    elif i < 20:
+        population = "רשות"
+    else:
+        population = "מחז"
+
+    content = render_record(item)
+    code = item.get("קוד_מענה") if isinstance(item, dict) else None
+    record_id = code if code is not None else f"index-{i}"
+    # A repeated code keeps every record indexed under its own key, stable while the file's order is
+    if occurrence > 1:
+        record_id = f"{record_id}:{occurrence}"
+
+    metadata = {
+        "source": source,
+        "type": doc_type,
+        "record": True,
+        "index": i,
+        "אוכלוסיה": population,
+        "קוד_מענה": code,
+        "record_key": f"{source}:{record_id}"
+    }
+    if isinstance(item, dict) and "תקציבים" in item:
+        metadata.update(parse_budgets(item["תקציבים"]))
+
+    return with_content_hash(Document(page_content=content, metadata=metadata))
+
+def iter_documents(file_path: str, source: str = None) -> Iterator[Document]:
+    """Stream documents from a data file one record at a time"""
+    # Source is the path relative to the corpus root, so records from different files never collide
+    source = source or os.path.basename(file_path)
     file_ext = Path(file_path).suffix.lower()
-    try:     
-        if file_ext == '.txt':
-            # Load text file
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-            
-            metadata = {
-                "source": os.path.basename(file_path),
-                "type": "text"
-            }
-            
-            documents.append(Document(page_content=content, metadata=metadata))
-            
-        elif file_ext == '.json':
-            # Load JSON file
-            with open(file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            #TODO: get the population from the json file
-            for i, item in enumerate(data):
-                if i < 10:
-                    population = "מוסד"
-                elif i < 20:
-                    population = "רשות"
-                else:
-                    population = "מחז"
-
-                content = json.dumps(item, indent=2, ensure_ascii=False)
-
-                metadata = {
-                    "source": os.path.basename(file_path),
-                    "type": "json",
-                    "index": i,
-                    "אוכלוסיה": population
-                }
-
-                documents.append(Document(page_content=content, metadata=metadata))
-            
+    if file_ext == '.txt':
+        # Load text file
+        with open(file_path, 'r', encoding='utf-8') as f:
+            content = f.read()
+        metadata = {
+            "source": source,
+            "type": "text",
+            "record_key": source
+        }
+        yield with_content_hash(Document(page_content=content, metadata=metadata))
+        return
+
+    if file_ext == '.json':
+        items = iter_json_items(file_path)
+    elif file_ext == '.csv':
+        items = (item for item in map(normalize_row, iter_csv_rows(file_path)) if item)
+    elif file_ext == '.xlsx':
+        items = (item for item in map(normalize_row, iter_xlsx_rows(file_path)) if item)
+    else:
+        return
+    occurrences = {}
+    for i, item in enumerate(items):
+        code = item.get("קוד_מענה") if isinstance(item, dict) else None
+        occurrences[code] = occurrences.get(code, 0) + 1
+        yield record_document(item, i, source, file_ext[1:], occurrences[code] if code is not None else 1)
+
+def iter_document_batches(file_path: str, source: str = None, batch_size: int = LOAD_BATCH_SIZE) -> Iterator[List[Document]]:
+    """Stream documents from a data file in batches ready for embedding"""
+    return iter_batches(iter_documents(file_path, source), batch_size)
+
+def load_document(file_path: str, source: str = None) -> List[Document]:
+    """Load and process document based on file type"""
+    try:
+        return list(iter_documents(file_path, source))
     except Exception as e:
         print(f"Error loading document {file_path}: {e}")
-        
-    return documents
+        return []
 
-def create_vectorstore(documents: List[Document]) -> FAISS:
-    """Create FAISS vector store from documents"""
-    if not documents:
-        raise ValueError("No documents provided")
-    
-    # Split documents into chunks
+def split_documents(documents: List[Document]) -> List[Document]:
+    """Split free text into chunks, keeping each record whole, with stable ids derived from the record key"""
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=1000,
         chunk_overlap=200,
         separators=["\n\n", "\n", " ", ""]
     )
     
-    splits = text_splitter.split_documents(documents)
-    print(f"Created {len(splits)} document chunks")
+    splits = []
+    for document in documents:
+        # A record is already one compact text, splitting it would only duplicate overlap
+        if document.metadata.get("record"):
+            chunks = [Document(page_content=document.page_content, metadata=dict(document.metadata))]
+        else:
+            chunks = text_splitter.split_documents([document])
+        for chunk_number, chunk in enumerate(chunks):
+            chunk.id = f"{document.metadata['record_key']}#{chunk_number}"
+        splits.extend(chunks)
+    return splits
+
+def create_vectorstore(documents: List[Document], progress=None) -> FAISS:
+    """Create FAISS vector store from documents"""
+    if not documents:
+        raise ValueError("No documents provided")
+    return create_vectorstore_from_batches([documents], progress=progress)
+
+def create_vectorstore_from_batches(batches: Iterable[List[Document]], progress=None) -> Optional[FAISS]:
+    """Create FAISS vector store from document batches, embedding each batch as soon as it is loaded"""
+    vectorstore = None
+    seen_keys = set()
+    chunks = 0
+    for batch in batches:
+        # Chunk ids derive from record keys, so a repeated record would collide
+        documents = [doc for doc in batch if _first_occurrence(doc, seen_keys)]
+        # Split documents into chunks
+        splits = split_documents(documents)
+        if not splits:
+            continue
+        offset = chunks
+        chunks += len(splits)
+        # Create vector store, embedding chunks in concurrent batches
+        vectorstore = add_documents_concurrently(vectorstore, splits, cached_embeddings,
+                                                 progress=_offset_progress(progress, offset, chunks))
+    print(f"Created {chunks} document chunks")
+    print(f"Embedding cache stats: {embedding_cache.stats()}")
+    # Vectors stream into an exact flat index; compact types are trained once everything is embedded
+    if vectorstore is not None:
+        convert_index(vectorstore)
+    return vectorstore
+
+def _first_occurrence(document: Document, seen_keys: set) -> bool:
+    key = document.metadata.get("record_key")
+    if key in seen_keys:
+        print(f"Skipping duplicate record {key}")
+        return False
+    seen_keys.add(key)
+    return True
+
+def _offset_progress(progress, offset: int, total: int):
+    """Report per-batch embedding progress as progress over everything loaded so far"""
+    if progress is None:
+        return None
+    return lambda embedded, _: progress(offset + embedded, total)
+
+def supports_incremental_update(vectorstore: FAISS) -> bool:
+    """Check that the vectorstore was built with record keys and content hashes"""
+    stored = list(vectorstore.docstore._dict.values())
+    return bool(stored) and all(
+        "record_key" in doc.metadata and "content_hash" in doc.metadata for doc in stored
+    )
+
+def update_vectorstore(vectorstore: FAISS, documents: Iterable[Document], progress=None, sources=None) -> Dict[str, int]:
+    """Apply only the added, changed and removed records to an existing vectorstore
+
+    documents may be a generator; it is consumed in LOAD_BATCH_SIZE batches. When sources
+    is given, documents holds only the records of those source files and records from
+    every other source are left untouched.
+    """
+    if is_memory_mapped(vectorstore):
+        # FAISS aborts the process when a memory-mapped index is resized
+        raise ValueError("Memory-mapped vectorstore is read-only, update a clone_vectorstore copy")
+    # Current state of the index: record key -> content hash and chunk ids
+    current_hashes = {}
+    current_ids = {}
+    for doc_id, doc in vectorstore.docstore._dict.items():
+        if sources is not None and doc.metadata.get("source") not in sources:
+            continue
+        key = doc.metadata["record_key"]
+        current_hashes[key] = doc.metadata["content_hash"]
+        current_ids.setdefault(key, []).append(doc_id)
+    
+    invalidate_metadata_index(vectorstore)
+    invalidate_lexical_index(vectorstore)
+    # HNSW cannot remove vectors and IVF keeps stale row ids after removal, so those
+    # indexes are updated as a flat index and rebuilt from scratch afterwards
+    rebuild = not isinstance(faiss.downcast_index(vectorstore.index), faiss.IndexFlatCodes)
+    if rebuild:
+        vectorstore.index = build_vector_index(index_vectors(vectorstore), "flat", vectorstore.index.metric_type)
+    
+    seen_keys = set()
+    stats = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0}
+    chunks = 0
+    for batch in iter_batches(documents, LOAD_BATCH_SIZE):
+        new_documents = [doc for doc in batch if _first_occurrence(doc, seen_keys)]
+        changed = [doc for doc in new_documents if doc.metadata["record_key"] in current_hashes
+                   and current_hashes[doc.metadata["record_key"]] != doc.metadata["content_hash"]]
+        added = [doc for doc in new_documents if doc.metadata["record_key"] not in current_hashes]
+        stats["added"] += len(added)
+        stats["updated"] += len(changed)
+        stats["unchanged"] += len(new_documents) - len(added) - len(changed)
+        
+        # Changed records keep their chunk ids, so the old chunks go before the new ones are added
+        stale_ids = [doc_id for doc in changed for doc_id in current_ids[doc.metadata["record_key"]]]
+        if stale_ids:
+            vectorstore.delete(stale_ids)
+        splits = split_documents(changed + added)
+        if splits:
+            offset = chunks
+            chunks += len(splits)
+            add_documents_concurrently(vectorstore, splits, cached_embeddings,
+                                       progress=_offset_progress(progress, offset, chunks))
     
-    # Create vector store
-    vectorstore = FAISS.from_documents(splits, embeddings)
+    removed = [key for key in current_hashes if key not in seen_keys]
+    stale_ids = [doc_id for key in removed for doc_id in current_ids[key]]
+    if stale_ids:
+        vectorstore.delete(stale_ids)
+    stats["removed"] = len(removed)
+    if rebuild:
+        convert_index(vectorstore)
+    print(f"Incremental vectorstore update: {stats}")
+    return stats
+
+def index_factory_description(index_type: str, dimension: int, ntotal: int) -> Optional[str]:
+    """Map an index type to a faiss.index_factory description, or None for an exact flat index"""
+    name = index_type.strip().lower().replace("-", "").replace("_", "")
+    if name in ("", "flat"):
+        return None
+    if name == "hnsw":
+        return f"HNSW{HNSW_M},Flat"
+    if name in ("sq", "sq8"):
+        return "SQ8"
+    if name == "ivfpq":
+        if ntotal < IVF_MIN_VECTORS:
+            print(f"Only {ntotal} vectors, IVF-PQ needs at least {IVF_MIN_VECTORS} to train, using a flat index")
+            return None
+        # About 4*sqrt(n) lists, with at least 39 training vectors per list
+        nlist = max(1, min(int(4 * ntotal ** 0.5), ntotal // 39))
+        pq_m = max(m for m in range(1, min(PQ_M, dimension) + 1) if dimension % m == 0)
+        return f"IVF{nlist},PQ{pq_m}x{PQ_NBITS}"
+    return index_type.strip()
+
+def build_vector_index(vectors: np.ndarray, index_type: str = None, metric: int = faiss.METRIC_L2) -> faiss.Index:
+    """Build a FAISS index of the given type over vectors, training it on a sample when needed"""
+    index_type = VECTOR_INDEX_TYPE if index_type is None else index_type
+    ntotal, dimension = vectors.shape
+    description = index_factory_description(index_type, dimension, ntotal)
+    if description is None:
+        index = faiss.IndexFlatIP(dimension) if metric == faiss.METRIC_INNER_PRODUCT else faiss.IndexFlatL2(dimension)
+        index.add(vectors)
+        return index
+    index = faiss.index_factory(dimension, description, metric)
+    base_index = faiss.downcast_index(index)
+    if isinstance(base_index, faiss.IndexHNSW):
+        base_index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        base_index.hnsw.efSearch = HNSW_EF_SEARCH
+    if not index.is_trained:
+        sample = vectors
+        if ntotal > INDEX_TRAIN_SAMPLE:
+            sample = vectors[np.random.default_rng(0).choice(ntotal, INDEX_TRAIN_SAMPLE, replace=False)]
+        index.train(sample)
+    if isinstance(base_index, faiss.IndexIVF):
+        base_index.nprobe = IVF_NPROBE
+    index.add(vectors)
+    return index
+
+def stored_vectors(index: faiss.Index) -> Optional[np.ndarray]:
+    """Read back every row's exact vector from indexes that store them uncompressed, None for lossy codes"""
+    base_index = faiss.downcast_index(index)
+    if isinstance(base_index, faiss.IndexFlat):
+        return base_index.reconstruct_n(0, base_index.ntotal)
+    if isinstance(base_index, faiss.IndexHNSW) and isinstance(faiss.downcast_index(base_index.storage), faiss.IndexFlat):
+        return base_index.reconstruct_n(0, base_index.ntotal)
+    if isinstance(base_index, faiss.IndexIVFFlat):
+        # IVF lists are keyed by centroid; the direct map finds each row's list entry
+        base_index.make_direct_map()
+        try:
+            return base_index.reconstruct_n(0, base_index.ntotal)
+        finally:
+            base_index.make_direct_map(False)
+    return None
+
+def index_vectors(vectorstore: FAISS) -> np.ndarray:
+    """Get the vectors of every index row, in row order"""
+    vectors = stored_vectors(vectorstore.index)
+    if vectors is not None:
+        return vectors
+    # SQ and PQ codes are lossy; re-embed through the batched pipeline, mostly served by the embedding cache
+    print(f"Re-embedding {vectorstore.index.ntotal} chunks to recover exact vectors from a {describe_index(vectorstore.index)} index")
+    texts = [vectorstore.docstore._dict[vectorstore.index_to_docstore_id[i]].page_content
+             for i in range(vectorstore.index.ntotal)]
+    vectors = np.zeros((len(texts), vectorstore.index.d), dtype="float32")
+    for start, batch_vectors in embed_in_batches(cached_embeddings, texts):
+        vectors[start:start + len(batch_vectors)] = batch_vectors
+    if vectorstore._normalize_L2:
+        faiss.normalize_L2(vectors)
+    return vectors
+
+def describe_index(index: faiss.Index) -> str:
+    """Short name of a FAISS index's concrete type, e.g. IndexHNSWFlat"""
+    return type(faiss.downcast_index(index)).__name__
+
+def convert_index(vectorstore: FAISS, index_type: str = None) -> FAISS:
+    """Rebuild the vectorstore's index as the configured type; row positions and ids are kept"""
+    index_type = VECTOR_INDEX_TYPE if index_type is None else index_type
+    ntotal = vectorstore.index.ntotal
+    is_flat = isinstance(faiss.downcast_index(vectorstore.index), faiss.IndexFlat)
+    if ntotal == 0 or (is_flat and index_factory_description(index_type, vectorstore.index.d, ntotal) is None):
+        return vectorstore
+    vectorstore.index = build_vector_index(index_vectors(vectorstore), index_type, vectorstore.index.metric_type)
+    invalidate_metadata_index(vectorstore)
+    invalidate_lexical_index(vectorstore)
+    print(f"Built {describe_index(vectorstore.index)} index over {ntotal} vectors")
     return vectorstore
 
-def save_vectorstore(vectorstore: FAISS, file_hash: str):
-    """Save vectorstore to disk"""
+DOCSTORE_FILE = "docstore.json"
+INDEX_FILE = "index.faiss"
+MANIFEST_FILE = "manifest.json"
+
+# Vectorstores whose index is a read-only memory-mapped view of index.faiss
+_memory_mapped = weakref.WeakSet()
+
+def is_memory_mapped(vectorstore: FAISS) -> bool:
+    """Check if the vectorstore's index is memory-mapped and must not be modified"""
+    return vectorstore in _memory_mapped
+
+def clone_vectorstore(vectorstore: FAISS) -> FAISS:
+    """Create an independent, writable copy of a vectorstore"""
+    index = faiss.deserialize_index(faiss.serialize_index(vectorstore.index))
+    docstore = InMemoryDocstore(dict(vectorstore.docstore._dict))
+    return FAISS(
+        cached_embeddings,
+        index,
+        docstore,
+        dict(vectorstore.index_to_docstore_id),
+        normalize_L2=vectorstore._normalize_L2,
+        distance_strategy=vectorstore.distance_strategy
+    )
+
+def save_vectorstore(vectorstore: FAISS, file_hash: str, manifest: Dict[str, str] = None):
+    """Save vectorstore to disk as index.faiss plus a JSON docstore and the source file manifest"""
     try:
         vectorstore_path = os.path.join(VECTORSTORE_DIR, f"vectorstore_{file_hash}")
-        vectorstore.save_local(vectorstore_path)
+        # Write to a temporary directory first so readers never see a half-written store
+        temp_path = f"{vectorstore_path}.tmp"
+        shutil.rmtree(temp_path, ignore_errors=True)
+        os.makedirs(temp_path)
+        faiss.write_index(vectorstore.index, os.path.join(temp_path, INDEX_FILE))
+        docstore = {
+            "index_to_docstore_id": [vectorstore.index_to_docstore_id[i] for i in range(len(vectorstore.index_to_docstore_id))],
+            "documents": {
+                doc_id: {"page_content": doc.page_content, "metadata": doc.metadata}
+                for doc_id, doc in vectorstore.docstore._dict.items()
+            },
+            "normalize_L2": vectorstore._normalize_L2,
+            "distance_strategy": vectorstore.distance_strategy.value,
+            "index_type": VECTOR_INDEX_TYPE
+        }
+        with open(os.path.join(temp_path, DOCSTORE_FILE), "w", encoding="utf-8") as f:
+            json.dump(docstore, f, ensure_ascii=False)
+        if manifest is not None:
+            with open(os.path.join(temp_path, MANIFEST_FILE), "w", encoding="utf-8") as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=2)
+        shutil.rmtree(vectorstore_path, ignore_errors=True)
+        os.replace(temp_path, vectorstore_path)
         print(f"Vectorstore saved: {vectorstore_path}")
         return True
     except Exception as e:
         print(f"Error saving vectorstore: {e}")
         return False
 
+def delete_vectorstore(file_hash: str):
+    """Delete a saved vectorstore; processes that memory-mapped it keep their view until they drop it"""
+    vectorstore_path = os.path.join(VECTORSTORE_DIR, f"vectorstore_{file_hash}")
+    try:
+        shutil.rmtree(vectorstore_path)
+        print(f"Deleted superseded vectorstore: {vectorstore_path}")
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"Error deleting vectorstore {vectorstore_path}: {e}")
+
+def load_manifest(file_hash: str):
+    """Load the source file -> hash manifest saved with a vectorstore, if any"""
+    manifest_path = os.path.join(VECTORSTORE_DIR, f"vectorstore_{file_hash}", MANIFEST_FILE)
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def read_index(index_path: str):
+    """Read a FAISS index memory-mapped so worker processes share its pages, falling back to a regular read"""
+    try:
+        return faiss.read_index(index_path, faiss.IO_FLAG_MMAP_IFC), True
+    except Exception as e:
+        print(f"Memory-mapped index read failed, reading into memory: {e}")
+        return faiss.read_index(index_path), False
+
 def load_vectorstore(file_hash: str) -> FAISS:
     """Load existing vectorstore from disk"""
     try:
         vectorstore_path = os.path.join(VECTORSTORE_DIR, f"vectorstore_{file_hash}")
+        docstore_path = os.path.join(vectorstore_path, DOCSTORE_FILE)
+        if os.path.exists(docstore_path):
+            index, memory_mapped = read_index(os.path.join(vectorstore_path, INDEX_FILE))
+            with open(docstore_path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+            documents = {
+                doc_id: Document(id=doc_id, page_content=doc["page_content"], metadata=doc["metadata"])
+                for doc_id, doc in stored["documents"].items()
+            }
+            vectorstore = FAISS(
+                cached_embeddings,
+                index,
+                InMemoryDocstore(documents),
+                dict(enumerate(stored["index_to_docstore_id"])),
+                normalize_L2=stored.get("normalize_L2", False),
+                distance_strategy=DistanceStrategy(stored.get("distance_strategy", DistanceStrategy.EUCLIDEAN_DISTANCE.value))
+            )
+            print(f"Loaded existing vectorstore: {vectorstore_path} (memory-mapped: {memory_mapped})")
+            if stored.get("index_type", "flat") != VECTOR_INDEX_TYPE:
+                # VECTOR_INDEX_TYPE changed since the store was built: convert once and save
+                print(f"Converting {describe_index(index)} index to {VECTOR_INDEX_TYPE}")
+                convert_index(vectorstore)
+                save_vectorstore(vectorstore, file_hash, load_manifest(file_hash))
+            if memory_mapped and vectorstore.index is index:
+                _memory_mapped.add(vectorstore)
+            return vectorstore
         if os.path.exists(vectorstore_path):
+            # Stores saved before the JSON docstore format still use the pickled index.pkl
             vectorstore = FAISS.load_local(
                 vectorstore_path,
-                embeddings,
+                cached_embeddings,
                 allow_dangerous_deserialization=True
             )
             print(f"Loaded existing vectorstore: {vectorstore_path}")
@@ -131,4 +646,4 @@ def load_vectorstore(file_hash: str) -> FAISS:
     except Exception as e:
         print(f"Error loading vectorstore: {e}")
     
-    return None
\ No newline at end of file
+    return None
@@ -0,0 +1,220 @@
+import time
+import threading
+import contextvars
+from bisect import bisect_left
+from typing import Dict, List, Optional, Tuple
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.runnables import RunnableLambda
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+COUNT_BUCKETS = (0, 1, 2, 4, 6, 10, 20, 50)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000)
+
+# Timing breakdown of the request currently being processed
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class Histogram:
+    """Prometheus-style cumulative histogram with labels"""
+
+    def __init__(self, name: str, description: str, buckets: Tuple[float, ...]):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self._series: Dict[Tuple, Dict] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.setdefault(key, {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            position = bisect_left(self.buckets, value)
+            if position < len(self.buckets):
+                series["counts"][position] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                label_text = ",".join(f'{name}="{value}"' for name, value in key)
+                prefix = f"{label_text}," if label_text else ""
+                cumulative = 0
+                for bound, count in zip(self.buckets, series["counts"]):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+                lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {series["count"]}')
+                suffix = f"{{{label_text}}}" if label_text else ""
+                lines.append(f"{self.name}_sum{suffix} {series['sum']}")
+                lines.append(f"{self.name}_count{suffix} {series['count']}")
+        return lines
+
+
+class Counter:
+    """Prometheus-style counter with labels"""
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                label_text = ",".join(f'{name}="{label}"' for name, label in key)
+                lines.append(f"{self.name}{{{label_text}}} {value}" if label_text else f"{self.name} {value}")
+        return lines
+
+
+node_duration = Histogram("rag_node_duration_seconds", "Wall time of each LangGraph node", LATENCY_BUCKETS)
+retrieved_docs = Histogram("rag_retrieved_docs", "Documents returned by retrieval", COUNT_BUCKETS)
+llm_duration = Histogram("rag_llm_call_duration_seconds", "Latency of Bedrock model calls, by answer or rewrite call", LATENCY_BUCKETS)
+llm_tokens = Histogram("rag_llm_tokens", "Prompt and response tokens per Bedrock call", TOKEN_BUCKETS)
+request_duration = Histogram("rag_request_duration_seconds", "End-to-end request latency", LATENCY_BUCKETS)
+node_errors = Counter("rag_node_errors_total", "Exceptions raised by LangGraph nodes")
+context_tokens = Histogram("rag_context_tokens", "Estimated prompt context tokens, built and saved by the context builder", TOKEN_BUCKETS)
+query_rewrites = Counter("rag_query_rewrites_total", "Query rewrite outcomes: rewritten, cached, timeout, saturated or error")
+answer_routes = Counter("rag_answer_routes_total", "How questions were answered: generate, no_match, single_match or retrieval_failed")
+
+METRICS = [node_duration, retrieved_docs, llm_duration, llm_tokens, request_duration, node_errors, context_tokens,
+           query_rewrites, answer_routes]
+
+
+def render_metrics() -> str:
+    """Render all metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def start_trace() -> dict:
+    """Begin collecting a timing breakdown for the current request"""
+    trace = {"nodes_ms": {}, "llm_calls": [], "retrieved_docs": None, "tokens": {"input": 0, "output": 0, "cache_read": 0}}
+    current_trace.set(trace)
+    return trace
+
+
+def record_context(stats: dict):
+    """Record the size of the prompt context and the tokens the context builder saved"""
+    context_tokens.observe(stats["context_tokens"], kind="context")
+    context_tokens.observe(stats["tokens_saved"], kind="saved")
+    trace = current_trace.get()
+    if trace is not None:
+        trace["context"] = {key: value for key, value in stats.items() if key != "context"}
+
+
+def record_route(route: str):
+    """Count the path that answers the question"""
+    answer_routes.inc(route=route)
+    trace = current_trace.get()
+    if trace is not None:
+        trace["route"] = route
+
+
+def _record_node(name: str, started: float, result):
+    elapsed = time.perf_counter() - started
+    node_duration.observe(elapsed, node=name)
+    docs = result.get("retrieved_docs") if isinstance(result, dict) else None
+    if docs is not None and name.startswith("retrieve"):
+        retrieved_docs.observe(len(docs), node=name)
+    trace = current_trace.get()
+    if trace is not None:
+        trace["nodes_ms"][name] = round(trace["nodes_ms"].get(name, 0) + elapsed * 1000, 3)
+        if docs is not None and name.startswith("retrieve"):
+            trace["retrieved_docs"] = len(docs)
+
+
+def traced_node(name: str, func) -> RunnableLambda:
+    """Wrap a graph node so its wall time and retrieved-doc count are recorded"""
+    def run(state):
+        started = time.perf_counter()
+        try:
+            result = func(state)
+        except Exception:
+            node_errors.inc(node=name)
+            raise
+        _record_node(name, started, result)
+        return result
+
+    return RunnableLambda(run, name=name)
+
+
+class LLMMetricsHandler(BaseCallbackHandler):
+    """Callback handler recording Bedrock call latency and token usage"""
+
+    def __init__(self):
+        self._started: Dict = {}
+        self._lock = threading.Lock()
+
+    def on_llm_start(self, serialized, prompts, *, run_id, metadata=None, **kwargs):
+        with self._lock:
+            self._started[run_id] = (time.perf_counter(), (metadata or {}).get("llm_call", "answer"))
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs):
+        with self._lock:
+            self._started[run_id] = (time.perf_counter(), (metadata or {}).get("llm_call", "answer"))
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        with self._lock:
+            started, call = self._started.pop(run_id, (None, "answer"))
+        elapsed = time.perf_counter() - started if started else 0.0
+        llm_duration.observe(elapsed, call=call)
+        input_tokens, output_tokens = self._usage(response)
+        cache_read = self._cache_read(response)
+        if input_tokens is not None:
+            llm_tokens.observe(input_tokens, kind="input")
+            llm_tokens.observe(output_tokens, kind="output")
+        if cache_read:
+            llm_tokens.observe(cache_read, kind="cache_read")
+        trace = current_trace.get()
+        if trace is not None:
+            trace["llm_calls"].append(round(elapsed * 1000, 3))
+            trace["tokens"]["input"] += input_tokens or 0
+            trace["tokens"]["output"] += output_tokens or 0
+            trace["tokens"]["cache_read"] += cache_read
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        with self._lock:
+            self._started.pop(run_id, None)
+        node_errors.inc(node="llm")
+
+    @staticmethod
+    def _usage(response) -> Tuple[Optional[int], Optional[int]]:
+        """Read token usage from the message metadata or the provider's llm_output"""
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if usage:
+                    return usage.get("input_tokens", 0), usage.get("output_tokens", 0)
+        usage = (response.llm_output or {}).get("usage") or {}
+        if usage:
+            return usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+        return None, None
+
+    @staticmethod
+    def _cache_read(response) -> int:
+        """Prompt tokens served from Bedrock's prompt cache"""
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                details = usage.get("input_token_details") or {}
+                if details.get("cache_read"):
+                    return details["cache_read"]
+        return 0
+
+
+llm_metrics_handler = LLMMetricsHandler()
+
+
+def tracing_config(llm_call: str = "answer") -> dict:
+    """Run config attaching the LLM metrics handler to a graph invocation; llm_call labels its model calls"""
+    return {"callbacks": [llm_metrics_handler], "metadata": {"llm_call": llm_call}}
@@ -0,0 +1,77 @@
+import os
+import time
+import threading
+from rag import file_signature
+from indexer import IndexManager, find_data_files, scan_corpus, FILES_DIR
+
+WATCH_INTERVAL = float(os.getenv("WATCH_INTERVAL", 2))
+# Wait for the file to stop changing for this long before reindexing
+WATCH_DEBOUNCE = float(os.getenv("WATCH_DEBOUNCE", 1))
+
+
+class FileWatcher:
+    """Polls FILES_DIR and submits a reindex once the corpus settles after a change"""
+
+    def __init__(self, manager: IndexManager, files_dir: str = FILES_DIR,
+                 interval: float = WATCH_INTERVAL, debounce: float = WATCH_DEBOUNCE):
+        self.manager = manager
+        self.files_dir = files_dir
+        self.interval = interval
+        self.debounce = debounce
+        self.last_job = None
+        self.reindexes = 0
+        self._seen = None
+        self._pending = None
+        self._changed_at = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def poll_once(self):
+        """Check the corpus files' stat signatures and reindex when a change has settled"""
+        data_files = find_data_files(self.files_dir)
+        if not data_files:
+            return
+        signature = tuple((data_file, file_signature(data_file)) for data_file in data_files)
+        if signature != self._seen:
+            # Still being written: restart the debounce window
+            self._seen = signature
+            self._pending = signature
+            self._changed_at = time.monotonic()
+            return
+        if self._pending is None or time.monotonic() - self._changed_at < self.debounce:
+            return
+
+        self._pending = None
+        # Only hash once stat says a file was added, removed or changed
+        manifest, corpus_hash = scan_corpus(self.files_dir)
+        _, current_hash = self.manager.snapshot()
+        if corpus_hash and corpus_hash != current_hash:
+            print(f"Detected change in {self.files_dir}, reindexing")
+            self.last_job = self.manager.submit(manifest, corpus_hash)
+            self.reindexes += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.poll_once()
+            except Exception as e:
+                print(f"Error watching {self.files_dir}: {e}")
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="file-watcher", daemon=True)
+        self._thread.start()
+        print(f"Watching {self.files_dir} every {self.interval}s")
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self) -> dict:
+        return {
+            "watching": bool(self._thread and self._thread.is_alive()),
+            "interval_seconds": self.interval,
+            "reindexes": self.reindexes,
+            "last_job_id": self.last_job.id if self.last_job else None
+        }